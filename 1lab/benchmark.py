@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import math
+import time
+import wave
+import random
+import socket
+import shutil
+import struct
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from array import array
+from datetime import datetime, timezone
+from protocol import TYPE_END, STATUS_OK, request_frame, recv_frame
+
+# нагрузочный тест: синтетическая библиотека, сервер в отдельном процессе,
+# N клиентов с разными сценариями, задержки по командам в json
+
+PATTERNS = ('sequential', 'random', 'hot', 'mixed')
+SAMPLE_RATE = 22050
+
+
+def generate_library(folder, tracks, duration, audio_format='wav', seed=0):
+    # тон с шумом, у каждого трека своя частота и длительность +-50%
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    names = []
+    for idx in range(tracks):
+        seconds = duration * rng.uniform(0.5, 1.5)
+        frequency = rng.uniform(110, 880)
+        name = f'track_{idx:04d}.wav'
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            samples = array('h', (
+                int(8000 * math.sin(2 * math.pi * frequency * n / SAMPLE_RATE) + rng.randint(-500, 500))
+                for n in range(int(seconds * SAMPLE_RATE))
+            ))
+            if sys.byteorder == 'big':
+                samples.byteswap()
+            with wave.open(path, 'wb') as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(SAMPLE_RATE)
+                wav.writeframes(samples.tobytes())
+        if audio_format == 'mp3':
+            from pydub import AudioSegment
+            mp3_name = name[:-4] + '.mp3'
+            mp3_path = os.path.join(folder, mp3_name)
+            if not os.path.exists(mp3_path):
+                AudioSegment.from_wav(path).export(mp3_path, format='mp3')
+            os.unlink(path)
+            name = mp3_name
+        names.append(name)
+    return names
+
+
+def percentile(sorted_values, fraction):
+    # ближайший ранг; sorted_values уже отсортирован
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def summarize(latencies, errors, elapsed):
+    values = sorted(latencies)
+    result = {
+        'count': len(values),
+        'errors': errors,
+        'throughput_rps': len(values) / elapsed if elapsed else 0.0
+    }
+    if values:
+        result.update({
+            'mean_ms': sum(values) / len(values) * 1000,
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p95_ms': percentile(values, 0.95) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'max_ms': values[-1] * 1000
+        })
+    return result
+
+
+def serve(options, ready):
+    # процесс сервера; логи DEBUG на каждый запрос искажают замеры
+    logging.disable(logging.INFO)
+    from server import Server
+    server = Server(**options['server'])
+    server.wait_ready()
+    ready.set()
+    if options['mode'] == 'async':
+        server.run_async()
+    else:
+        server.run()
+
+
+class BenchClient:
+    # минимальный клиент без логов и файлов: меряем сервер, а не Client
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.request_id = 0
+
+    def call(self, command, **params):
+        # (успех, байт получено)
+        self.request_id += 1
+        self.sock.sendall(request_frame(self.request_id, command, **params))
+        ok, received = True, 0
+        while True:
+            frame = recv_frame(self.sock)
+            if frame is None:
+                raise ConnectionError('Сервер закрыл соединение')
+            frame_type, status, _, payload = frame
+            received += len(payload)
+            ok = ok and status == STATUS_OK
+            # get_segments отвечает потоком кадров до TYPE_END
+            if command != 'get_segments' or frame_type == TYPE_END:
+                return ok, received
+
+    def close(self):
+        self.sock.close()
+
+
+class Worker(threading.Thread):
+    def __init__(self, pattern, catalog, args, seed, deadline):
+        super().__init__(daemon=True)
+        self.pattern = pattern
+        self.catalog = catalog
+        self.args = args
+        self.rng = random.Random(seed)
+        self.deadline = deadline
+        self.latencies = {}
+        self.errors = {}
+        self.bytes = 0
+        names = sorted(catalog)
+        self.names = names
+        # hot: популярность по закону Ципфа
+        self.weights = [1 / (rank + 1) ** args.zipf for rank in range(len(names))]
+
+    def requests(self):
+        pattern = self.pattern
+        if pattern == 'mixed':
+            pattern = self.rng.choice(PATTERNS[:-1])
+        if pattern == 'sequential':
+            # слушатель: метаданные, затем трек по порядку
+            name = self.rng.choice(self.names)
+            yield 'get_metadata', {}
+            for idx in range(self.catalog[name]['segments']):
+                yield 'get_part_of_audio', {'file_name': name, 'segment_idx': idx}
+        elif pattern == 'random':
+            name = self.rng.choice(self.names)
+            if self.rng.random() < self.args.range_share:
+                duration_ms = int(self.catalog[name]['duration'] * 1000)
+                length = self.rng.randint(1000, 10000)
+                start = self.rng.randint(0, max(duration_ms - length, 0))
+                yield 'get_range', {'file_name': name, 'start_ms': start, 'end_ms': start + length}
+            else:
+                idx = self.rng.randrange(self.catalog[name]['segments'])
+                yield 'get_part_of_audio', {'file_name': name, 'segment_idx': idx}
+        else:
+            name = self.rng.choices(self.names, self.weights)[0]
+            idx = self.rng.randrange(self.catalog[name]['segments'])
+            yield 'get_part_of_audio', {'file_name': name, 'segment_idx': idx}
+
+    def run(self):
+        client = None
+        while time.monotonic() < self.deadline:
+            for command, params in self.requests():
+                if time.monotonic() >= self.deadline:
+                    break
+                try:
+                    if client is None:
+                        client = BenchClient(self.args.host, self.args.port, self.args.timeout)
+                    started = time.perf_counter()
+                    ok, received = client.call(command, **params)
+                    elapsed = time.perf_counter() - started
+                except (OSError, ConnectionError, struct.error):
+                    ok, elapsed, received = False, None, 0
+                    if client is not None:
+                        client.close()
+                        client = None
+                self.bytes += received
+                if ok:
+                    self.latencies.setdefault(command, []).append(elapsed)
+                else:
+                    self.errors[command] = self.errors.get(command, 0) + 1
+        if client is not None:
+            client.close()
+
+
+def fetch_json(args, command):
+    # библиотека загружена, но сокет сервера мог еще не открыться
+    for _ in range(50):
+        try:
+            client = BenchClient(args.host, args.port, args.timeout)
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    else:
+        raise RuntimeError(f'Сервер не слушает {args.host}:{args.port}')
+    try:
+        client.request_id += 1
+        client.sock.sendall(request_frame(client.request_id, command))
+        _, status, _, payload = recv_frame(client.sock)
+        return json.loads(payload.decode('utf-8'))
+    finally:
+        client.close()
+
+
+def run_pattern(args, pattern, server_options):
+    ready = multiprocessing.Event()
+    # свежий процесс на каждый сценарий: кэш сегментов холодный
+    process = multiprocessing.Process(target=serve, args=(server_options, ready), daemon=True)
+    process.start()
+    try:
+        if not ready.wait(args.startup_timeout):
+            raise RuntimeError('Сервер не загрузил библиотеку вовремя')
+        catalog = {name: info for name, info in fetch_json(args, 'get_metadata').items() if info.get('segments')}
+        deadline = time.monotonic() + args.duration
+        workers = [
+            Worker(pattern, catalog, args, args.seed * 1000 + idx, deadline)
+            for idx in range(args.clients)
+        ]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        # метрики самого сервера: время экспорта, кэш, байты
+        server_stats = fetch_json(args, 'stats')
+    finally:
+        process.terminate()
+        process.join()
+
+    latencies, errors = {}, {}
+    for worker in workers:
+        for command, values in worker.latencies.items():
+            latencies.setdefault(command, []).extend(values)
+        for command, count in worker.errors.items():
+            errors[command] = errors.get(command, 0) + count
+    commands = {
+        command: summarize(latencies.get(command, []), errors.get(command, 0), elapsed)
+        for command in sorted(set(latencies) | set(errors))
+    }
+    total = summarize([v for values in latencies.values() for v in values], sum(errors.values()), elapsed)
+    total['bytes'] = sum(worker.bytes for worker in workers)
+    total['mbytes_per_s'] = total['bytes'] / elapsed / 1024 / 1024 if elapsed else 0.0
+    total['elapsed_s'] = elapsed
+    return {'total': total, 'commands': commands, 'server': server_stats}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест аудио сервера')
+    parser.add_argument('--host', default='localhost', help='Адрес сервера')
+    parser.add_argument('--port', type=int, default=8989, help='Порт сервера')
+    parser.add_argument('--mode', choices=['threads', 'async'], default='threads', help='Режим сервера')
+    parser.add_argument('--lazy', action='store_true', help='Ленивый режим сервера')
+    parser.add_argument('--prerender', action='store_true', help='Хранилище готовых сегментов')
+    parser.add_argument('--cache-mb', type=int, default=64, help='Кэш сегментов сервера в МБ')
+    parser.add_argument('--workers', type=int, default=None, help='Потоки экспорта (async)')
+    parser.add_argument('--tracks', type=int, default=20, help='Число треков в библиотеке')
+    parser.add_argument('--track-seconds', type=float, default=60, help='Средняя длительность трека')
+    parser.add_argument('--format', choices=['wav', 'mp3'], default='wav', help='Формат треков')
+    parser.add_argument('--library', help='Папка библиотеки (по умолчанию временная)')
+    parser.add_argument('--clients', type=int, default=8, help='Число одновременных клиентов')
+    parser.add_argument('--duration', type=float, default=10, help='Длительность сценария в секундах')
+    parser.add_argument('--patterns', default='sequential,random,hot',
+                        help=f'Сценарии через запятую: {", ".join(PATTERNS)}')
+    parser.add_argument('--range-share', type=float, default=0.25, help='Доля get_range в сценарии random')
+    parser.add_argument('--zipf', type=float, default=1.2, help='Показатель Ципфа для сценария hot')
+    parser.add_argument('--timeout', type=float, default=30, help='Таймаут сокета клиента')
+    parser.add_argument('--startup-timeout', type=float, default=300, help='Сколько ждать загрузки библиотеки')
+    parser.add_argument('--seed', type=int, default=1, help='Зерно генератора')
+    parser.add_argument('--output', default='benchmark.json', help='Файл с результатами')
+    args = parser.parse_args()
+
+    patterns = [p.strip() for p in args.patterns.split(',') if p.strip()]
+    unknown = set(patterns) - set(PATTERNS)
+    if unknown:
+        parser.error(f'Неизвестные сценарии: {", ".join(sorted(unknown))}')
+
+    work_dir = tempfile.mkdtemp(prefix='audio_bench_')
+    library = os.path.abspath(args.library) if args.library else os.path.join(work_dir, 'audio')
+    try:
+        print(f'Генерация библиотеки: {args.tracks} треков в {library}')
+        generate_library(library, args.tracks, args.track_seconds, args.format, args.seed)
+        server_options = {
+            'mode': args.mode,
+            'server': {
+                'host': args.host,
+                'port': args.port,
+                'audio_folder': library,
+                'lazy': args.lazy,
+                'cache_size': args.cache_mb * 1024 * 1024,
+                'export_workers': args.workers,
+                'prerender': args.prerender,
+                'store_folder': os.path.join(work_dir, 'segments'),
+                'catalog_file': os.path.join(work_dir, 'audio_metadata.json'),
+                'frames_folder': os.path.join(work_dir, 'frames'),
+                'peaks_folder': os.path.join(work_dir, 'peaks'),
+                'log_every': 0
+            }
+        }
+        results = {}
+        for pattern in patterns:
+            print(f'Сценарий {pattern}: {args.clients} клиентов, {args.duration} с')
+            results[pattern] = run_pattern(args, pattern, server_options)
+            total = results[pattern]['total']
+            print(
+                f'  {total["count"]} запросов, {total["errors"]} ошибок, '
+                f'{total["throughput_rps"]:.1f} запр/с, '
+                f'p50 {total.get("p50_ms", 0):.2f} мс, p95 {total.get("p95_ms", 0):.2f} мс, '
+                f'p99 {total.get("p99_ms", 0):.2f} мс'
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'started': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'patterns': results
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    print(f'Результаты записаны в {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import os
+import json
+import hashlib
+from collections import namedtuple
+
+class CatalogSnapshot(namedtuple('CatalogSnapshot', ['version', 'track_info', 'track_segments', 'names'])):
+    # то, что видят обработчики запросов; после публикации не меняется,
+    # names - отсортированные имена треков для постраничной выдачи и поиска по префиксу
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, version, track_info, track_segments):
+        return cls(version, track_info, track_segments, sorted(track_info))
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Catalog:
+    # audio_metadata.json: размер, mtime, хэш, длительность и число сегментов каждого трека
+    def __init__(self, path):
+        self.path = path
+        self.version = 0
+        self.segment_length = None
+        self.tracks = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict):
+            return
+        if 'tracks' in data:
+            self.version = data.get('version', 0)
+            self.segment_length = data.get('segment_length')
+            self.tracks = data['tracks']
+        else:
+            # старый формат: только имя и длительность, файлы придется перепроверить
+            self.tracks = data
+
+    def save(self):
+        data = {
+            'version': self.version,
+            'segment_length': self.segment_length,
+            'tracks': self.tracks
+        }
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(temp_path, self.path)
+
+    def is_unchanged(self, name, stat):
+        entry = self.tracks.get(name)
+        return (
+            entry is not None
+            and entry.get('size') == stat.st_size
+            and entry.get('mtime') == stat.st_mtime_ns
+            and entry.get('segments') is not None
+        )
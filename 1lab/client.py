@@ -5,12 +5,56 @@ import socket
 import argparse
 import tempfile
 import shutil
+import threading
+import time
+import random
+import functools
+from protocol import (
+    TYPE_AUDIO, TYPE_END, STATUS_OK, STATUS_RESTART, STATUS_BUSY, MAX_REQUEST_ID, ServerBusy,
+    request_frame, recv_header, recv_exact, recv_frame, decode_json
+)
+from sharding import HashRing, parse_node
+
+
+def retry_when_busy(failed=None):
+    # сервер ответил "занято": ждем retry_after с растущей паузой и повторяем,
+    # после BUSY_RETRIES попыток возвращаем failed
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            for attempt in range(self.BUSY_RETRIES + 1):
+                try:
+                    return method(self, *args, **kwargs)
+                except ServerBusy as busy:
+                    if attempt == self.BUSY_RETRIES:
+                        self.log.error(f'{busy}, попытки закончились')
+                        return failed
+                    delay = busy.retry_after * 2 ** attempt * random.uniform(1, 1.5)
+                    self.log.warning(f'{busy}, ждем {delay:.2f} с')
+                    time.sleep(delay)
+        return wrapper
+    return decorator
 
 class Client:
+    # сколько секунд верим закэшированным метаданным сервера
+    CATALOG_TTL = 30
+    # недокачанные временные файлы старее этого (в секундах) удаляются
+    STALE_TEMP_AGE = 3600
+    # сколько раз повторять запрос, на который сервер ответил "занято"
+    BUSY_RETRIES = 5
+    # размер страницы при постраничном чтении каталога
+    PAGE_SIZE = 500
+
     def __init__(self, host='localhost', port=8899):
         self.host = host
         self.port = port
         self.connection = None
+        self.catalog = None
+        self.catalog_version = None
+        self.catalog_time = 0
+        self.request_id = 0
+        # ответы, пришедшие раньше, чем их начали ждать
+        self.pending = {}
         script_dir = os.path.dirname(os.path.abspath(__file__))
         log_dir = os.path.join(script_dir, 'logs')
         os.makedirs(log_dir, exist_ok=True)
@@ -18,6 +62,9 @@ class Client:
         os.makedirs(self.result_dir, exist_ok=True)
         self.temp_dir = os.path.join(script_dir, 'temp')
         os.makedirs(self.temp_dir, exist_ok=True)
+        # локальный кэш сегментов, имя файла - хэш содержимого трека и индекс
+        self.cache_dir = os.path.join(script_dir, 'cache')
+        os.makedirs(self.cache_dir, exist_ok=True)
         log_file = os.path.join(log_dir, 'client.log')
         logging.basicConfig(
             level=logging.DEBUG,
@@ -31,52 +78,328 @@ class Client:
         self.log.info('Клиент инициализирован')
         self.log.info(f'Выходные файлы: {self.result_dir}')
         self.log.info(f'Временные файлы: {self.temp_dir}')
+        self.remove_stale_temp_files()
+
+    def remove_stale_temp_files(self):
+        now = time.time()
+        for name in os.listdir(self.temp_dir):
+            path = os.path.join(self.temp_dir, name)
+            try:
+                if name.endswith('.mp3.temp') and now - os.path.getmtime(path) > self.STALE_TEMP_AGE:
+                    os.unlink(path)
+                    self.log.debug(f'Удален старый временный файл: {path}')
+            except OSError:
+                pass
 
     def connect_to_server(self):
         self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.pending = {}
         try:
             self.log.info(f'Подключение к {self.host}:{self.port}')
             self.connection.connect((self.host, self.port))
             return True
         except Exception as e:
             self.log.error(f'Ошибка подключения: {str(e)}', exc_info=True)
+            self.connection = None
             return False
 
-    def download_audio_segment(self, track_name, segment_idx, save_path):
+    def next_request_id(self):
+        self.request_id = self.request_id % MAX_REQUEST_ID + 1
+        return self.request_id
+
+    def send_request(self, command, **params):
         if not self.connection:
             if not self.connect_to_server():
+                return None
+        request_id = self.next_request_id()
+        self.connection.sendall(request_frame(request_id, command, **params))
+        return request_id
+
+    def read_header(self, request_id):
+        # кадры чужих запросов (при конвейерной отправке) откладываем
+        while True:
+            header = recv_header(self.connection)
+            if header is None:
+                raise ConnectionError('Сервер закрыл соединение')
+            frame_type, status, rid, length = header
+            if status == STATUS_BUSY and rid in (request_id, 0):
+                self.raise_busy(rid, recv_exact(self.connection, length))
+            if rid == request_id:
+                return frame_type, status, length
+            self.pending[rid] = (frame_type, status, recv_exact(self.connection, length))
+
+    def raise_busy(self, request_id, payload):
+        try:
+            retry_after = float(json.loads(payload.decode('utf-8'))['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            retry_after = 1.0
+        if request_id == 0:
+            # сервер отказал в соединении и закрыл его
+            self.disconnect()
+        raise ServerBusy(retry_after)
+
+    def take_pending(self, request_id):
+        frame_type, status, payload = self.pending.pop(request_id)
+        if status == STATUS_BUSY:
+            self.raise_busy(request_id, payload)
+        return frame_type, status, payload
+
+    def read_response(self, request_id):
+        if request_id in self.pending:
+            return self.take_pending(request_id)
+        frame_type, status, length = self.read_header(request_id)
+        return frame_type, status, recv_exact(self.connection, length)
+
+    @retry_when_busy()
+    def request(self, command, **params):
+        try:
+            request_id = self.send_request(command, **params)
+            if request_id is None:
+                return None
+            frame_type, status, payload = self.read_response(request_id)
+            result = decode_json(frame_type, payload)
+            if status != STATUS_OK:
+                self.log.error(f'Ошибка сервера: {result.get("error")}')
+                return None
+            return result
+        except ServerBusy:
+            raise
+        except Exception as e:
+            self.log.error(f'Ошибка при выполнении {command}: {str(e)}', exc_info=True)
+            # после сбоя посреди кадра соединение в неизвестном состоянии
+            self.disconnect()
+            return None
+
+    def get_metadata(self, **query):
+        # query: cursor, limit, prefix, contains, fields, since, compress;
+        # без них сервер отдает весь каталог словарем
+        return self.request('get_metadata', **query)
+
+    def refresh(self, wait=True):
+        # wait=False - сервер загружает изменения в фоне и сразу отвечает
+        if not wait:
+            return self.request('refresh', wait=False)
+        return self.request('refresh')
+
+    def get_audio_list(self, **query):
+        return self.request('get_audio_list', **query)
+
+    def iter_catalog(self, command='get_metadata', **query):
+        # страницы каталога по порядку имен; None в конце, если запрос не удался
+        query.setdefault('limit', self.PAGE_SIZE)
+        while True:
+            page = self.request(command, **query)
+            if page is None:
+                yield None
+                return
+            yield page
+            if page['next_cursor'] is None:
+                return
+            query['cursor'] = page['next_cursor']
+
+    def sync_catalog(self):
+        # после первого чтения просим у сервера только изменения с нашей версии
+        if self.catalog is not None and self.catalog_version is not None:
+            delta = self.get_metadata(since=self.catalog_version, compress=True)
+            if delta is None:
+                return False
+            if not delta['full']:
+                for name in delta['removed']:
+                    self.catalog.pop(name, None)
+                self.catalog.update(delta['changed'])
+                self.catalog_version = delta['version']
+                return True
+        catalog = {}
+        version = None
+        for page in self.iter_catalog(compress=True):
+            if page is None:
+                return False
+            if version is not None and page['version'] != version:
+                # каталог поменялся посреди чтения, начинаем заново
+                return self.sync_catalog()
+            version = page['version']
+            catalog.update(page['tracks'])
+        self.catalog = catalog
+        self.catalog_version = version
+        return True
+
+    def watch_catalog(self):
+        # генератор событий об изменении каталога; соединение лучше держать отдельное,
+        # пока подписка активна, ответы на другие запросы перемешаны с событиями
+        try:
+            request_id = self.send_request('subscribe')
+            if request_id is None:
+                return
+            _, status, payload = self.read_response(request_id)
+            result = json.loads(payload.decode('utf-8'))
+            if status != STATUS_OK:
+                self.log.error(f'Ошибка сервера: {result.get("error")}')
+                return
+            self.log.info(f'Подписка на изменения каталога, версия {result["version"]}')
+            while True:
+                _, _, payload = self.read_response(request_id)
+                event = json.loads(payload.decode('utf-8'))
+                # закэшированные метаданные устарели, следующий track_entry заберет изменения
+                self.catalog_time = 0
+                yield event
+        except (ConnectionError, OSError) as e:
+            self.log.error(f'Подписка прервана: {str(e)}')
+            self.disconnect()
+
+    def get_peaks(self, track_name, start_ms=None, end_ms=None, level=None, width=None):
+        # min/max/rms столбики формы волны; значения от -scale до scale
+        params = {'file_name': track_name}
+        for key, value in (('start_ms', start_ms), ('end_ms', end_ms), ('level', level), ('width', width)):
+            if value is not None:
+                params[key] = value
+        return self.request('get_peaks', **params)
+
+    def get_stats(self, text=False):
+        if text:
+            result = self.request('stats', format='text')
+            return result['text'] if result is not None else None
+        return self.request('stats')
+
+    def track_entry(self, track_name):
+        if self.catalog is None or track_name not in self.catalog \
+                or time.monotonic() - self.catalog_time > self.CATALOG_TTL:
+            if self.catalog is not None and track_name not in self.catalog:
+                # трек мог появиться, пока версия каталога еще не сменилась
+                self.catalog_version = None
+            self.sync_catalog()
+            self.catalog_time = time.monotonic()
+        return (self.catalog or {}).get(track_name)
+
+    def cache_path(self, track_name, segment_idx):
+        # None - сервер не сообщает хэш трека, кэшировать нельзя
+        entry = self.track_entry(track_name)
+        if not entry or not entry.get('hash'):
+            return None
+        return os.path.join(self.cache_dir, f'{entry["hash"]}_{entry["segments"]}_{segment_idx}.mp3')
+
+    def download_audio_segment(self, track_name, segment_idx, save_path):
+        cache_path = self.cache_path(track_name, segment_idx)
+        if cache_path is None:
+            self.log.info(f'Отправка запроса на получение части аудио: {track_name}, {segment_idx}')
+            return self.download_to_file(
+                save_path,
+                'get_part_of_audio',
+                file_name=track_name,
+                segment_idx=segment_idx
+            )
+        if os.path.exists(cache_path):
+            self.log.info(f'Сегмент {segment_idx} {track_name} взят из локального кэша')
+        elif not self.fetch_to_cache(track_name, segment_idx, cache_path):
+            return False
+        save_dir = os.path.dirname(save_path)
+        if save_dir:
+            os.makedirs(save_dir, exist_ok=True)
+        shutil.copyfile(cache_path, save_path)
+        self.log.info(f'Аудио файл успешно сохранен в {save_path}')
+        return True
+
+    @retry_when_busy(False)
+    def fetch_to_cache(self, track_name, segment_idx, cache_path):
+        # недокачанный сегмент лежит в .part, его полный размер - в .part.size;
+        # при повторе просим у сервера только недостающий хвост
+        partial_path = cache_path + '.part'
+        size_path = partial_path + '.size'
+        params = {'file_name': track_name, 'segment_idx': segment_idx}
+        offset = 0
+        try:
+            if os.path.exists(partial_path) and os.path.exists(size_path):
+                offset = os.path.getsize(partial_path)
+                with open(size_path, 'r') as f:
+                    params['size'] = int(f.read())
+                params['offset'] = offset
+                self.log.info(f'Докачка сегмента {segment_idx} {track_name} с байта {offset}')
+        except (OSError, ValueError):
+            offset = 0
+        try:
+            self.log.info(f'Отправка запроса на получение части аудио: {track_name}, {segment_idx}')
+            request_id = self.send_request('get_part_of_audio', **params)
+            if request_id is None:
+                return False
+            if request_id in self.pending:
+                frame_type, status, payload = self.take_pending(request_id)
+                data_size = len(payload)
+            else:
+                payload = None
+                frame_type, status, data_size = self.read_header(request_id)
+            if frame_type != TYPE_AUDIO:
+                error = payload if payload is not None else recv_exact(self.connection, data_size)
+                self.log.error(f'Ошибка сервера: {error.decode("utf-8")}')
+                return False
+            if status == STATUS_RESTART:
+                self.log.info('Сегмент на сервере изменился, качаем заново')
+                offset = 0
+
+            with open(size_path, 'w') as f:
+                f.write(str(offset + data_size))
+            with open(partial_path, 'r+b' if offset else 'wb') as f:
+                f.seek(offset)
+                f.truncate()
+                if payload is not None:
+                    f.write(payload)
+                    received = data_size
+                else:
+                    received = self.copy_payload(f, data_size)
+            if received != data_size:
+                # .part остается, следующая попытка продолжит с этого места
+                self.log.error(f'Получено {received} из {data_size}, докачаем при повторе')
+                self.disconnect()
                 return False
+            os.replace(partial_path, cache_path)
+            os.unlink(size_path)
+            return True
+        except ServerBusy:
+            raise
+        except Exception as e:
+            self.log.error(f'Ошибка при получении части аудио: {str(e)}', exc_info=True)
+            self.disconnect()
+            return False
+
+    def download_range(self, track_name, start_ms, end_ms, save_path):
+        self.log.info(f'Отправка запроса на диапазон {start_ms}-{end_ms} мс: {track_name}')
+        return self.download_to_file(
+            save_path,
+            'get_range',
+            file_name=track_name,
+            start_ms=start_ms,
+            end_ms=end_ms
+        )
+
+    @retry_when_busy(False)
+    def download_to_file(self, save_path, command, **params):
         temp_path = None
         try:
             save_dir = os.path.dirname(save_path)
             if save_dir:
                 os.makedirs(save_dir, exist_ok=True)
 
-            request = {
-                'command': 'get_part_of_audio',
-                'file_name': track_name,
-                'segment_idx': segment_idx
-            }
-            self.log.info(f'Отправка запроса на получение части аудио: {request}')
-            self.connection.send(json.dumps(request).encode('utf-8'))
+            request_id = self.send_request(command, **params)
+            if request_id is None:
+                return False
+
+            if request_id in self.pending:
+                frame_type, status, payload = self.take_pending(request_id)
+                if frame_type != TYPE_AUDIO:
+                    self.log.error(f'Ошибка сервера: {payload.decode("utf-8")}')
+                    return False
+                with open(save_path, 'wb') as f:
+                    f.write(payload)
+                return True
 
-            size_info = self.connection.recv(8)
-            if not size_info:
+            frame_type, status, data_size = self.read_header(request_id)
+            if frame_type != TYPE_AUDIO:
+                error = recv_exact(self.connection, data_size).decode('utf-8')
+                self.log.error(f'Ошибка сервера: {error}')
                 return False
-            data_size = int.from_bytes(size_info, byteorder='big')
             temp_file, temp_path = tempfile.mkstemp(dir=self.temp_dir, suffix='.mp3.temp')
             self.log.debug(f'Создан временный файл: {temp_path}')
 
-            received = 0
             with os.fdopen(temp_file, 'wb') as tmp:
-                while received < data_size:
-                    chunk_size = min(4096, data_size - received)
-                    data_chunk = self.connection.recv(chunk_size)
-                    if not data_chunk:
-                        self.log.error('Соединение прервано')
-                        break
-                    tmp.write(data_chunk)
-                    received += len(data_chunk)
+                received = self.copy_payload(tmp, data_size)
 
             if received == data_size:
                 shutil.move(temp_path, save_path)
@@ -84,9 +407,13 @@ class Client:
                 return True
             else:
                 self.log.error(f'Получено неверное количество данных: {received} из {data_size}')
+                self.disconnect()
                 return False
+        except ServerBusy:
+            raise
         except Exception as e:
             self.log.error(f'Ошибка при получении части аудио: {str(e)}', exc_info=True)
+            self.disconnect()
             return False
         finally:
             if temp_path and os.path.exists(temp_path):
@@ -96,25 +423,400 @@ class Client:
                 except Exception as e:
                     self.log.error(f'Ошибка при удалении временного файла: {str(e)}')
 
+    def copy_payload(self, file, data_size):
+        # данные кадра из сокета сразу в файл, возвращает сколько получено
+        received = 0
+        while received < data_size:
+            chunk_size = min(65536, data_size - received)
+            data_chunk = self.connection.recv(chunk_size)
+            if not data_chunk:
+                self.log.error('Соединение прервано')
+                break
+            file.write(data_chunk)
+            received += len(data_chunk)
+        return received
+
+    @retry_when_busy()
+    def fetch_segment(self, track_name, segment_idx):
+        cache_path = self.cache_path(track_name, segment_idx)
+        if cache_path is not None:
+            if not os.path.exists(cache_path) and not self.fetch_to_cache(track_name, segment_idx, cache_path):
+                return None
+            with open(cache_path, 'rb') as f:
+                return f.read()
+        try:
+            request_id = self.send_request(
+                'get_part_of_audio',
+                file_name=track_name,
+                segment_idx=segment_idx
+            )
+            if request_id is None:
+                return None
+            frame_type, status, payload = self.read_response(request_id)
+            if frame_type != TYPE_AUDIO:
+                self.log.error(f'Сегмент {segment_idx}: {payload.decode("utf-8")}')
+                return None
+            return payload
+        except ServerBusy:
+            raise
+        except Exception as e:
+            self.log.error(f'Ошибка при получении сегмента {segment_idx}: {str(e)}', exc_info=True)
+            self.disconnect()
+            return None
+
+    @retry_when_busy(False)
+    def download_track(self, track_name, save_path, segments=None):
+        # один запрос get_segments, сегменты пишутся в файл по мере прихода
+        temp_path = None
+        try:
+            save_dir = os.path.dirname(save_path)
+            if save_dir:
+                os.makedirs(save_dir, exist_ok=True)
+            params = {'file_name': track_name}
+            if segments is not None:
+                params['segments'] = list(segments)
+            self.log.info(f'Запрос сегментов {track_name}: {params.get("segments", "весь трек")}')
+            request_id = self.send_request('get_segments', **params)
+            if request_id is None:
+                return False
+
+            success = True
+            temp_file, temp_path = tempfile.mkstemp(dir=self.temp_dir, suffix='.mp3.temp')
+            with os.fdopen(temp_file, 'wb') as tmp:
+                while True:
+                    frame_type, status, data_size = self.read_header(request_id)
+                    if frame_type == TYPE_END:
+                        break
+                    if frame_type != TYPE_AUDIO:
+                        error = recv_exact(self.connection, data_size).decode('utf-8')
+                        self.log.error(f'Ошибка сервера: {error}')
+                        success = False
+                        continue
+                    if self.copy_payload(tmp, data_size) != data_size:
+                        raise ConnectionError('Соединение прервано')
+
+            if success:
+                shutil.move(temp_path, save_path)
+                self.log.info(f'Трек успешно сохранен в {save_path}')
+            return success
+        except ServerBusy:
+            # трек целиком запрашивается заново, остаток потока уйдет в pending
+            raise
+        except Exception as e:
+            self.log.error(f'Ошибка при получении трека: {str(e)}', exc_info=True)
+            self.disconnect()
+            return False
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    def download_track_parallel(self, track_name, save_path, workers=4, window=None):
+        # сегменты качаются в workers соединений, а в файл пишутся строго по порядку,
+        # так что каждый попадает на свое смещение; вперед забегаем не больше чем на window
+        metadata = self.get_metadata()
+        if not metadata or track_name not in metadata:
+            self.log.error(f'Нет такого файла: {track_name}')
+            return False
+        count = metadata[track_name]['segments']
+        window = window or workers * 4
+        ready = {}
+        state = {'next': 0, 'written': 0}
+        condition = threading.Condition()
+
+        def worker():
+            client = Client(self.host, self.port)
+            try:
+                while True:
+                    with condition:
+                        while state['next'] - state['written'] >= window:
+                            condition.wait()
+                        segment_idx = state['next']
+                        if segment_idx >= count:
+                            return
+                        state['next'] += 1
+                    data = client.fetch_segment(track_name, segment_idx)
+                    with condition:
+                        ready[segment_idx] = data
+                        condition.notify_all()
+            finally:
+                client.disconnect()
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(workers, count))]
+        for thread in threads:
+            thread.start()
+
+        temp_path = None
+        success = True
+        try:
+            save_dir = os.path.dirname(save_path)
+            if save_dir:
+                os.makedirs(save_dir, exist_ok=True)
+            temp_file, temp_path = tempfile.mkstemp(dir=self.temp_dir, suffix='.mp3.temp')
+            with os.fdopen(temp_file, 'wb') as tmp:
+                for segment_idx in range(count):
+                    with condition:
+                        while segment_idx not in ready:
+                            condition.wait()
+                        data = ready.pop(segment_idx)
+                        state['written'] = segment_idx + 1
+                        condition.notify_all()
+                    if data is None:
+                        success = False
+                        continue
+                    tmp.write(data)
+            if success:
+                shutil.move(temp_path, save_path)
+                self.log.info(f'Трек успешно сохранен в {save_path} ({workers} соединений)')
+            return success
+        finally:
+            for thread in threads:
+                thread.join()
+            if temp_path and os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    def download_audio_segments(self, track_name, segment_indices, save_dir, window=16):
+        # конвейер: в полете до window запросов, ответы сопоставляются по id
+        os.makedirs(save_dir, exist_ok=True)
+        base_name = os.path.splitext(track_name)[0]
+        results = {}
+        in_flight = {}
+        busy_retries = {}
+        queue = list(segment_indices)
+        position = 0
+        try:
+            while position < len(queue) or in_flight:
+                while position < len(queue) and len(in_flight) < window:
+                    segment_idx = queue[position]
+                    position += 1
+                    request_id = self.send_request(
+                        'get_part_of_audio',
+                        file_name=track_name,
+                        segment_idx=segment_idx
+                    )
+                    if request_id is None:
+                        return results
+                    in_flight[request_id] = segment_idx
+
+                request_id = next((rid for rid in in_flight if rid in self.pending), None)
+                if request_id is not None:
+                    frame_type, status, payload = self.pending.pop(request_id)
+                else:
+                    frame = recv_frame(self.connection)
+                    if frame is None:
+                        raise ConnectionError('Сервер закрыл соединение')
+                    frame_type, status, request_id, payload = frame
+                    if request_id not in in_flight:
+                        self.pending[request_id] = (frame_type, status, payload)
+                        continue
+
+                segment_idx = in_flight.pop(request_id)
+                if status == STATUS_BUSY and busy_retries.get(segment_idx, 0) < self.BUSY_RETRIES:
+                    # сегмент уходит в конец очереди, а конвейер притормаживает
+                    busy_retries[segment_idx] = busy_retries.get(segment_idx, 0) + 1
+                    queue.append(segment_idx)
+                    time.sleep(json.loads(payload.decode('utf-8')).get('retry_after', 1.0))
+                    continue
+                if frame_type != TYPE_AUDIO:
+                    self.log.error(f'Сегмент {segment_idx}: {payload.decode("utf-8")}')
+                    results[segment_idx] = None
+                    continue
+                save_path = os.path.join(save_dir, f'{base_name}_{segment_idx}.mp3')
+                with open(save_path, 'wb') as f:
+                    f.write(payload)
+                results[segment_idx] = save_path
+        except Exception as e:
+            self.log.error(f'Ошибка при конвейерной загрузке: {str(e)}', exc_info=True)
+            self.disconnect()
+        return results
+
     def disconnect(self):
         if self.connection:
             self.connection.close()
             self.connection = None
             self.log.info("Соединение с сервером закрыто.")
 
+class ShardedClient:
+    # клиент кластера: у трека несколько узлов-владельцев по кольцу, запрос идет основному,
+    # а если тот не отвечает или трека у него нет - следующей реплике
+    # сколько секунд не начинать с узла, до которого не удалось достучаться
+    DOWN_TIMEOUT = 5
+
+    def __init__(self, nodes, replicas=2, vnodes=100):
+        self.ring = HashRing(nodes, replicas, vnodes)
+        self.clients = {}
+        self.down_until = {}
+        self.log = logging.getLogger(__name__)
+
+    def client(self, node):
+        if node not in self.clients:
+            host, port = parse_node(node)
+            self.clients[node] = Client(host, port)
+        return self.clients[node]
+
+    def route(self, track_name):
+        # владельцы по порядку кольца, недавно упавшие - в конец
+        now = time.monotonic()
+        return sorted(self.ring.owners(track_name), key=lambda node: self.down_until.get(node, 0) > now)
+
+    def call(self, track_name, method, *args, **kwargs):
+        result = None
+        for node in self.route(track_name):
+            client = self.client(node)
+            result = getattr(client, method)(track_name, *args, **kwargs)
+            if result is not None and result is not False:
+                self.down_until.pop(node, None)
+                return result
+            if client.connection is None:
+                self.down_until[node] = time.monotonic() + self.DOWN_TIMEOUT
+                self.log.warning(f'Узел {node} недоступен, пробуем реплику')
+            else:
+                self.log.warning(f'Узел {node} не отдал {track_name}, пробуем реплику')
+        return result
+
+    def get_metadata(self, **query):
+        # каталог кластера - объединение шардов; треки недоступного узла приходят
+        # от его реплик, поэтому узел может не ответить, пока у его треков есть другие владельцы
+        catalog = {}
+        failed = []
+        for node in self.ring.nodes:
+            for page in self.client(node).iter_catalog(**query):
+                if page is None:
+                    failed.append(node)
+                    break
+                catalog.update(page['tracks'])
+        if len(failed) == len(self.ring.nodes):
+            return None
+        if failed:
+            self.log.warning(f'Не ответили узлы {", ".join(failed)}, '
+                             f'каталог полон, если у их треков есть живые реплики')
+        return dict(sorted(catalog.items()))
+
+    def get_audio_list(self, **query):
+        catalog = self.get_metadata(**dict(query, fields=['name']))
+        return list(catalog) if catalog is not None else None
+
+    def shards(self):
+        # что каждый узел сам сообщает о своем шарде; None - узел не ответил
+        result = {}
+        for node in self.ring.nodes:
+            page = self.client(node).get_metadata(limit=1)
+            result[node] = page.get('shard') if page is not None else None
+            if result[node] is not None and (
+                    result[node]['nodes'] != self.ring.nodes or result[node]['replicas'] != self.ring.replicas):
+                self.log.warning(f'У узла {node} другой состав кластера: {result[node]}')
+        return result
+
+    def get_stats(self, text=False):
+        return {node: self.client(node).get_stats(text) for node in self.ring.nodes}
+
+    def refresh(self, wait=True):
+        return {node: self.client(node).refresh(wait) for node in self.ring.nodes}
+
+    def fetch_segment(self, track_name, segment_idx):
+        return self.call(track_name, 'fetch_segment', segment_idx)
+
+    def download_audio_segment(self, track_name, segment_idx, save_path):
+        return self.call(track_name, 'download_audio_segment', segment_idx, save_path)
+
+    def download_range(self, track_name, start_ms, end_ms, save_path):
+        return self.call(track_name, 'download_range', start_ms, end_ms, save_path)
+
+    def download_track(self, track_name, save_path, segments=None):
+        return self.call(track_name, 'download_track', save_path, segments)
+
+    def download_track_parallel(self, track_name, save_path, workers=4, window=None):
+        return self.call(track_name, 'download_track_parallel', save_path, workers, window)
+
+    def get_peaks(self, track_name, start_ms=None, end_ms=None, level=None, width=None):
+        return self.call(track_name, 'get_peaks', start_ms, end_ms, level, width)
+
+    def disconnect(self):
+        for client in self.clients.values():
+            client.disconnect()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Клиент для получения метаданных аудио файлов')
-    parser.add_argument('action', choices=['get', 'refresh', 'cut', 'list'],
-                      help='Команда: get - получить метаданные, refresh - обновить метаданные, cut - получить часть аудио, list - показать список файлов')
+    parser.add_argument('action', choices=['get', 'refresh', 'cut', 'list', 'range', 'track', 'stats', 'watch', 'peaks', 'shards'],
+                      help='Команда: get - получить метаданные, refresh - обновить метаданные, cut - получить часть аудио, list - показать список файлов, range - получить произвольный диапазон, track - скачать трек или список сегментов целиком, stats - метрики сервера, watch - ждать изменений каталога, peaks - форма волны, shards - шарды узлов кластера')
     parser.add_argument('--file', type=str, help='Имя файла для получения сегмента')
     parser.add_argument('--segment', type=int, help='Индекс сегмента (от 0)')
+    parser.add_argument('--start', type=int, help='Начало диапазона в мс (для range)')
+    parser.add_argument('--end', type=int, help='Конец диапазона в мс (для range)')
+    parser.add_argument('--segments', type=str, help='Индексы сегментов через запятую (для track)')
+    parser.add_argument('--parallel', type=int, default=1, help='Число параллельных соединений (для track)')
     parser.add_argument('--output', help='Имя выходного файла (будет сохранен в директорию output)')
+    parser.add_argument('--text', action='store_true', help='Метрики в текстовом виде (для stats)')
+    parser.add_argument('--prefix', help='Только треки с этим префиксом (для get и list)')
+    parser.add_argument('--contains', help='Только треки, в имени которых есть подстрока (для get и list)')
+    parser.add_argument('--limit', type=int, help='Размер страницы (для get и list)')
+    parser.add_argument('--cursor', help='Имя, после которого начинать страницу (для get и list)')
+    parser.add_argument('--fields', help='Поля метаданных через запятую (для get)')
+    parser.add_argument('--since', type=int, help='Только изменения после этой версии каталога (для get)')
+    parser.add_argument('--compress', action='store_true', help='Сжимать ответ zlib (для get и list)')
+    parser.add_argument('--level', type=int, help='Уровень пирамиды пиков (для peaks)')
+    parser.add_argument('--width', type=int, help='Сколько столбиков нужно, если не задан --level (для peaks)')
+    parser.add_argument('--nodes', help='Узлы кластера через запятую (host:port,host:port), запросы идут по шардам')
+    parser.add_argument('--replicas', type=int, default=2, help='На скольких узлах хранится каждый трек (для --nodes)')
     args = parser.parse_args()
 
-    client = Client(host='localhost', port=8899)
+    if args.nodes:
+        if args.action == 'watch' or args.cursor or args.since is not None or args.limit:
+            print('С --nodes не поддерживаются watch, --cursor, --since и --limit')
+            exit(1)
+        client = ShardedClient(args.nodes.split(','), args.replicas)
+    else:
+        if args.action == 'shards':
+            print('Необходимо указать --nodes для команды shards')
+            exit(1)
+        client = Client(host='localhost', port=8899)
 
     try:
-        if args.action == 'cut':
+        if args.action in ('get', 'refresh', 'list'):
+            query = {
+                key: value for key, value in (
+                    ('prefix', args.prefix), ('contains', args.contains), ('limit', args.limit),
+                    ('cursor', args.cursor), ('since', args.since),
+                    ('fields', args.fields.split(',') if args.fields else None)
+                ) if value is not None
+            }
+            if args.compress:
+                query['compress'] = True
+            if args.action == 'get':
+                result = client.get_metadata(**query)
+            elif args.action == 'refresh':
+                result = client.refresh()
+            else:
+                result = client.get_audio_list(**query)
+            if result is None:
+                print('Не удалось выполнить команду')
+            else:
+                print(json.dumps(result, ensure_ascii=False, indent=4))
+        elif args.action == 'shards':
+            print(json.dumps(client.shards(), ensure_ascii=False, indent=4))
+        elif args.action == 'stats':
+            result = client.get_stats(args.text)
+            if result is None:
+                print('Не удалось получить метрики')
+            elif args.text:
+                print(result, end='')
+            else:
+                print(json.dumps(result, ensure_ascii=False, indent=4))
+        elif args.action == 'peaks':
+            if not args.file:
+                print('Необходимо указать --file для команды peaks')
+                exit(1)
+            result = client.get_peaks(args.file, args.start, args.end, args.level, args.width)
+            if result is None:
+                print('Не удалось получить пики')
+            else:
+                print(json.dumps(result, ensure_ascii=False))
+        elif args.action == 'watch':
+            try:
+                for event in client.watch_catalog():
+                    print(json.dumps(event, ensure_ascii=False, indent=4))
+            except KeyboardInterrupt:
+                pass
+        elif args.action == 'cut':
             if not all([args.file, args.segment is not None, args.output]):
                 print('Необходимо указать --file, --segment и --output для команды cut')
                 exit(1)
@@ -123,5 +825,34 @@ if __name__ == '__main__':
                 print(f'Аудио успешно получено и сохранено в {output_path}')
             else:
                 print('Не удалось получить часть аудио')
+        elif args.action == 'range':
+            if not all([args.file, args.start is not None, args.end is not None, args.output]):
+                print('Необходимо указать --file, --start, --end и --output для команды range')
+                exit(1)
+            output_path = os.path.join(client.result_dir, args.output)
+            if client.download_range(args.file, args.start, args.end, output_path):
+                print(f'Диапазон успешно получен и сохранен в {output_path}')
+            else:
+                print('Не удалось получить диапазон')
+        elif args.action == 'track':
+            if not all([args.file, args.output]):
+                print('Необходимо указать --file и --output для команды track')
+                exit(1)
+            output_path = os.path.join(client.result_dir, args.output)
+            if args.segments:
+                try:
+                    segments = [int(idx) for idx in args.segments.split(',')]
+                except ValueError:
+                    print('--segments должен быть списком чисел через запятую')
+                    exit(1)
+                success = client.download_track(args.file, output_path, segments)
+            elif args.parallel > 1:
+                success = client.download_track_parallel(args.file, output_path, args.parallel)
+            else:
+                success = client.download_track(args.file, output_path)
+            if success:
+                print(f'Трек успешно получен и сохранен в {output_path}')
+            else:
+                print('Не удалось получить трек')
     finally:
         client.disconnect()
\ No newline at end of file
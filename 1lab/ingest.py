@@ -0,0 +1,97 @@
+import os
+import io
+import math
+import wave
+import traceback
+from pydub import AudioSegment
+from pydub.utils import mediainfo
+from catalog import file_hash
+from segment_store import SegmentStore
+from mp3_index import FrameIndex, index_path
+from peaks import PeakPyramid, peaks_path
+
+# функции выполняются в отдельных процессах ProcessPoolExecutor,
+# поэтому все нужное передается в задании, а не берется из Server
+
+
+def probe_duration(full_path):
+    # длительность в мс без декодирования всего файла
+    if full_path.endswith('.wav'):
+        try:
+            with wave.open(full_path, 'rb') as wav:
+                return wav.getnframes() * 1000 / wav.getframerate()
+        except wave.Error:
+            pass  # не PCM wav, пусть разбирается ffprobe
+    info = mediainfo(full_path)
+    return float(info['duration']) * 1000
+
+
+def split_segments(audio, segment_length):
+    # аудио на сегменты
+    return [
+        audio[start_ms:start_ms + segment_length]
+        for start_ms in range(0, len(audio), segment_length)
+    ]
+
+
+def export_segment(segment):
+    buffer = io.BytesIO()
+    segment.export(buffer, format='mp3')
+    return buffer.getvalue()
+
+
+def ingest_file(job):
+    # job: name, path, segment_length, entry (из каталога или None), check_hash,
+    # decode (нужны сегменты в памяти), prerender_root (куда рендерить или None),
+    # frames_root (куда положить индекс кадров mp3 или None),
+    # peaks_root (куда положить пирамиду пиков или None)
+    result = {'name': job['name'], 'entry': None, 'audio': None, 'changed': False, 'error': None}
+    try:
+        full_path = job['path']
+        stat = os.stat(full_path)
+        entry = job['entry']
+        content_hash = None
+        if job['check_hash'] or entry is None:
+            content_hash = file_hash(full_path)
+            if entry is not None and entry.get('hash') == content_hash:
+                # файл трогали, но содержимое то же
+                entry = dict(entry, size=stat.st_size, mtime=stat.st_mtime_ns)
+            else:
+                entry = None
+                result['changed'] = True
+
+        store = SegmentStore(job['prerender_root']) if job['prerender_root'] else None
+        render = store is not None and (result['changed'] or not store.is_fresh(job['name'], full_path))
+        stamp = SegmentStore.source_stamp(full_path)
+        peaks_file = peaks_path(job['peaks_root'], job['name']) if job.get('peaks_root') else None
+        build_peaks = peaks_file is not None and (result['changed'] or not PeakPyramid.is_fresh(peaks_file, stamp))
+        audio = None
+        if job['decode'] or render or build_peaks:
+            audio = AudioSegment.from_file(full_path)
+        if entry is None:
+            duration_ms = len(audio) if audio is not None else probe_duration(full_path)
+            entry = {
+                'name': job['name'],
+                'duration': duration_ms / 1000,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'hash': content_hash
+            }
+        entry = dict(entry, segments=math.ceil(entry['duration'] * 1000 / job['segment_length']))
+
+        if render:
+            segments = split_segments(audio, job['segment_length'])
+            store.render(job['name'], full_path, (export_segment(s) for s in segments))
+        if build_peaks:
+            PeakPyramid.from_audio(audio).save(peaks_file, stamp)
+        if job['frames_root'] and full_path.endswith('.mp3'):
+            frames_path = index_path(job['frames_root'], job['name'])
+            if result['changed'] or not FrameIndex.is_fresh(frames_path, stamp):
+                FrameIndex.build(full_path).save(frames_path, stamp)
+        if job['decode']:
+            result['audio'] = audio
+        result['entry'] = entry
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+        result['traceback'] = traceback.format_exc()
+    return result
@@ -0,0 +1,101 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+
+# верхние границы корзин гистограммы задержек в секундах
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')
+)
+
+
+class Histogram:
+    # фиксированные корзины: запись O(log корзин), память не растет
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        # оценка сверху: граница корзины, в которую попал нужный ранг
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        result = {'count': self.count, 'sum_s': self.total, 'max_s': self.max}
+        for name, fraction in (('p50_s', 0.5), ('p95_s', 0.95), ('p99_s', 0.99)):
+            result[name] = self.percentile(fraction)
+        return result
+
+
+class Metrics:
+    # счетчики, текущие значения и гистограммы сервера; все под одной блокировкой
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = self.gauges.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'uptime_s': time.time() - self.started,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {name: h.summary() for name, h in self.histograms.items()}
+            }
+
+    def render_text(self, extra=None):
+        # плоский текст "имя значение" по строке, extra - словарь дополнительных значений
+        snapshot = self.snapshot()
+        lines = [f'uptime_seconds {snapshot["uptime_s"]:.3f}']
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'{name} {value}')
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append(f'{name} {value}')
+        for name, summary in sorted(snapshot['histograms'].items()):
+            for key, value in summary.items():
+                if value is not None:
+                    lines.append(f'{name}.{key} {value:.6f}' if isinstance(value, float) else f'{name}.{key} {value}')
+        for name, value in sorted((extra or {}).items()):
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, extra=None):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render_text(extra))
+        os.replace(temp_path, path)
@@ -0,0 +1,157 @@
+import os
+import math
+import struct
+import hashlib
+from array import array
+
+# битрейты в кбит/с: [MPEG1 или MPEG2/2.5][слой I, II, III][индекс]
+BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG1
+    2: [22050, 24000, 16000],  # MPEG2
+    0: [11025, 12000, 8000],   # MPEG2.5
+}
+LAYERS = {3: 1, 2: 2, 1: 3}
+
+# заголовок файла индекса: метка, размер и mtime исходника, частота,
+# сэмплов в кадре, число кадров, конец аудиоданных
+INDEX_HEADER = struct.Struct('!4sQQIIQQ')
+INDEX_MAGIC = b'MP3I'
+
+
+def index_path(root, track_name):
+    return os.path.join(root, hashlib.sha1(track_name.encode('utf-8')).hexdigest() + '.frames')
+
+
+def parse_frame_header(data):
+    # (длина кадра, частота, сэмплов в кадре) или None, если это не заголовок
+    if len(data) < 4 or data[0] != 0xFF or data[1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (data[1] >> 3) & 0x03
+    layer = LAYERS.get((data[1] >> 1) & 0x03)
+    bitrate_idx = data[2] >> 4
+    rate_idx = (data[2] >> 2) & 0x03
+    if version_bits == 1 or layer is None or bitrate_idx in (0, 15) or rate_idx == 3:
+        return None
+    padding = (data[2] >> 1) & 0x01
+    sample_rate = SAMPLE_RATES[version_bits][rate_idx]
+    mpeg1 = version_bits == 3
+    bitrate = BITRATES[(1 if mpeg1 else 2, layer)][bitrate_idx] * 1000
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, sample_rate, 384
+    if layer == 3 and not mpeg1:
+        return 72 * bitrate // sample_rate + padding, sample_rate, 576
+    return 144 * bitrate // sample_rate + padding, sample_rate, 1152
+
+
+def skip_id3v2(data):
+    if len(data) >= 10 and data[:3] == b'ID3':
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+class FrameIndex:
+    # смещения кадров mp3 в файле, чтобы резать по времени без декодирования
+    def __init__(self, offsets, data_end, sample_rate, samples_per_frame):
+        self.offsets = offsets
+        self.data_end = data_end
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+
+    @property
+    def frame_ms(self):
+        return self.samples_per_frame * 1000 / self.sample_rate
+
+    @property
+    def duration_ms(self):
+        return len(self.offsets) * self.frame_ms
+
+    @classmethod
+    def build(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        position = skip_id3v2(data)
+        end = len(data)
+        if end - position >= 128 and data[end - 128:end - 125] == b'TAG':
+            end -= 128  # ID3v1 в конце файла
+        offsets = array('Q')
+        data_end = position
+        sample_rate = samples_per_frame = None
+        while position + 4 <= end:
+            header = parse_frame_header(data[position:position + 4])
+            if header is None or (sample_rate is not None and header[1] != sample_rate):
+                # мусор между кадрами, ищем следующую синхронизацию
+                position = data.find(b'\xff', position + 1, end)
+                if position < 0:
+                    break
+                continue
+            length, rate, samples = header
+            if position + length > end:
+                break
+            if sample_rate is None:
+                sample_rate, samples_per_frame = rate, samples
+                # первый кадр с заголовком Xing/Info звука не содержит
+                if b'Xing' in data[position:position + 64] or b'Info' in data[position:position + 64]:
+                    position += length
+                    continue
+            offsets.append(position)
+            position += length
+            data_end = position
+        if not offsets:
+            raise ValueError(f'В файле {path} не найдено mp3 кадров')
+        return cls(offsets, data_end, sample_rate, samples_per_frame)
+
+    def byte_range(self, start_ms, end_ms):
+        # границы по кадрам: берем все кадры, пересекающие [start_ms, end_ms)
+        # первые кадры могут ссылаться на резервуар битов предыдущих,
+        # декодер на стыке может дать короткий щелчок
+        count = len(self.offsets)
+        first = min(int(start_ms // self.frame_ms), count)
+        last = min(math.ceil(end_ms / self.frame_ms), count)
+        if first >= last:
+            return None
+        start = self.offsets[first]
+        end = self.offsets[last] if last < count else self.data_end
+        return start, end - start
+
+    def save(self, path, stamp):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(INDEX_HEADER.pack(
+                INDEX_MAGIC, stamp[0], stamp[1], self.sample_rate,
+                self.samples_per_frame, len(self.offsets), self.data_end
+            ))
+            self.offsets.tofile(f)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def is_fresh(path, stamp):
+        try:
+            with open(path, 'rb') as f:
+                magic, size, mtime = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))[:3]
+        except (OSError, struct.error):
+            return False
+        return magic == INDEX_MAGIC and [size, mtime] == list(stamp)
+
+    @classmethod
+    def load(cls, path, stamp):
+        # None, если индекса нет или он построен для другой версии файла
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(INDEX_HEADER.size)
+                magic, size, mtime, sample_rate, samples, count, data_end = INDEX_HEADER.unpack(header)
+                if magic != INDEX_MAGIC or [size, mtime] != list(stamp):
+                    return None
+                offsets = array('Q')
+                offsets.fromfile(f, count)
+        except (OSError, EOFError, struct.error):
+            return None
+        return cls(offsets, data_end, sample_rate, samples)
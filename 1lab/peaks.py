@@ -0,0 +1,147 @@
+import os
+import math
+import struct
+import hashlib
+import numpy as np
+
+# пирамида пиков для отрисовки формы волны: на уровне 0 каждый столбик -
+# BASE_BLOCK сэмплов, на каждом следующем столбики вдвое шире
+BASE_BLOCK = 256
+# значения хранятся в int16: -PEAK_SCALE..PEAK_SCALE соответствует -1..1
+PEAK_SCALE = 32767
+
+# заголовок файла: метка, размер и mtime исходника, частота, сэмплов в столбике уровня 0,
+# число уровней; дальше по уровням: число столбиков и массивы min, max, rms
+PEAK_HEADER = struct.Struct('!4sQQIIH')
+LEVEL_HEADER = struct.Struct('!Q')
+PEAK_MAGIC = b'PEAK'
+PEAK_DTYPE = np.dtype('<i2')
+
+
+def peaks_path(root, track_name):
+    return os.path.join(root, hashlib.sha1(track_name.encode('utf-8')).hexdigest() + '.peaks')
+
+
+class PeakPyramid:
+    def __init__(self, levels, sample_rate, base_block=BASE_BLOCK):
+        # levels: список (mins, maxs, rms) массивов int16 одной длины
+        self.levels = levels
+        self.sample_rate = sample_rate
+        self.base_block = base_block
+
+    def bin_ms(self, level):
+        return self.base_block * 2 ** level * 1000 / self.sample_rate
+
+    @classmethod
+    def from_samples(cls, samples, sample_rate, channels=1, sample_width=2, base_block=BASE_BLOCK):
+        # samples - сэмплы вперемешку по каналам, как отдает get_array_of_samples
+        data = np.asarray(samples, dtype=np.float32)
+        if channels > 1:
+            data = data[:len(data) // channels * channels].reshape(-1, channels).mean(axis=1)
+        data /= float(2 ** (8 * sample_width - 1))
+        if not len(data):
+            raise ValueError('Нет сэмплов для построения пиков')
+
+        # уровень 0: дополняем нулями до целого числа столбиков и считаем по строкам
+        bins = math.ceil(len(data) / base_block)
+        padded = np.zeros(bins * base_block, dtype=np.float32)
+        padded[:len(data)] = data
+        blocks = padded.reshape(bins, base_block)
+        mins = blocks.min(axis=1)
+        maxs = blocks.max(axis=1)
+        power = np.square(blocks).mean(axis=1)
+
+        levels = [cls._quantize(mins, maxs, power)]
+        # следующие уровни из предыдущего: пары столбиков сливаются в один
+        while len(mins) > 1:
+            if len(mins) % 2:
+                mins = np.append(mins, mins[-1])
+                maxs = np.append(maxs, maxs[-1])
+                power = np.append(power, power[-1])
+            mins = np.minimum(mins[0::2], mins[1::2])
+            maxs = np.maximum(maxs[0::2], maxs[1::2])
+            power = (power[0::2] + power[1::2]) / 2
+            levels.append(cls._quantize(mins, maxs, power))
+        return cls(levels, sample_rate, base_block)
+
+    @classmethod
+    def from_audio(cls, audio):
+        return cls.from_samples(
+            audio.get_array_of_samples(),
+            audio.frame_rate,
+            audio.channels,
+            audio.sample_width
+        )
+
+    @staticmethod
+    def _quantize(mins, maxs, power):
+        def scale(values):
+            return np.clip(np.rint(values * PEAK_SCALE), -PEAK_SCALE, PEAK_SCALE).astype(PEAK_DTYPE)
+        return scale(mins), scale(maxs), scale(np.sqrt(power))
+
+    def level_for_width(self, start_ms, end_ms, width):
+        # самый подробный уровень, на котором диапазон умещается в width столбиков
+        for level in range(len(self.levels)):
+            if (end_ms - start_ms) / self.bin_ms(level) <= width:
+                return level
+        return len(self.levels) - 1
+
+    def query(self, level, start_ms, end_ms):
+        # срезы массивов уровня, пересекающие [start_ms, end_ms)
+        mins, maxs, rms = self.levels[level]
+        bin_ms = self.bin_ms(level)
+        first = min(int(start_ms // bin_ms), len(mins))
+        last = min(math.ceil(end_ms / bin_ms), len(mins))
+        return {
+            'level': level,
+            'levels': len(self.levels),
+            'bin_ms': bin_ms,
+            'start_ms': first * bin_ms,
+            'scale': PEAK_SCALE,
+            'min': mins[first:last].tolist(),
+            'max': maxs[first:last].tolist(),
+            'rms': rms[first:last].tolist()
+        }
+
+    def save(self, path, stamp):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(PEAK_HEADER.pack(
+                PEAK_MAGIC, stamp[0], stamp[1], self.sample_rate, self.base_block, len(self.levels)
+            ))
+            for mins, maxs, rms in self.levels:
+                f.write(LEVEL_HEADER.pack(len(mins)))
+                for values in (mins, maxs, rms):
+                    f.write(values.astype(PEAK_DTYPE, copy=False).tobytes())
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def is_fresh(path, stamp):
+        try:
+            with open(path, 'rb') as f:
+                magic, size, mtime = PEAK_HEADER.unpack(f.read(PEAK_HEADER.size))[:3]
+        except (OSError, struct.error):
+            return False
+        return magic == PEAK_MAGIC and [size, mtime] == list(stamp)
+
+    @classmethod
+    def load(cls, path, stamp):
+        # None, если файла нет или он построен для другой версии трека
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            magic, size, mtime, sample_rate, base_block, count = PEAK_HEADER.unpack_from(data)
+            if magic != PEAK_MAGIC or [size, mtime] != list(stamp):
+                return None
+            offset = PEAK_HEADER.size
+            levels = []
+            for _ in range(count):
+                bins, = LEVEL_HEADER.unpack_from(data, offset)
+                offset += LEVEL_HEADER.size
+                arrays = []
+                for _ in range(3):
+                    arrays.append(np.frombuffer(data, PEAK_DTYPE, bins, offset))
+                    offset += bins * PEAK_DTYPE.itemsize
+                levels.append(tuple(arrays))
+        except (OSError, struct.error, ValueError):
+            return None
+        return cls(levels, sample_rate, base_block)
@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+
+class Prefetcher:
+    # при последовательном чтении трека заранее готовит следующие depth сегментов
+    # в кэш сегментов; подготовленные, но еще не запрошенные данные не превышают budget
+    # access - состояние одного соединения: трек -> (последний индекс, длина серии подряд)
+    MAX_TRACKS_PER_CONNECTION = 64
+
+    def __init__(self, cache, render, depth=2, budget=16 * 1024 * 1024, workers=2, metrics=None):
+        self.cache = cache
+        # render(track, idx) -> байты, уже положенные в кэш, или None (пропустить)
+        self.render = render
+        self.depth = depth
+        self.budget = budget
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self.scheduled = {}
+        self.unused = OrderedDict()
+        self.unused_bytes = 0
+        self._lock = threading.Lock()
+
+    def _count(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.inc(name, value)
+
+    def observe(self, access, track_name, segment_idx, segment_count):
+        last = access.pop(track_name, None)
+        run = last[1] + 1 if last is not None and segment_idx == last[0] + 1 else 1
+        access[track_name] = (segment_idx, run)
+        if len(access) > self.MAX_TRACKS_PER_CONNECTION:
+            access.pop(next(iter(access)))
+        self.consume(track_name, segment_idx)
+        # трек слушают с начала или уже два сегмента подряд - дальше, скорее всего, следующий
+        if run >= 2 or segment_idx == 0:
+            end = min(segment_idx + 1 + self.depth, segment_count)
+            self.schedule(track_name, range(segment_idx + 1, end))
+
+    def consume(self, track_name, segment_idx):
+        with self._lock:
+            size = self.unused.pop((track_name, segment_idx), None)
+            if size is not None:
+                self.unused_bytes -= size
+        if size is not None:
+            self._count('prefetch.hits')
+
+    def schedule(self, track_name, indices):
+        with self._lock:
+            self._forget_evicted()
+            for segment_idx in indices:
+                key = (track_name, segment_idx)
+                if key in self.scheduled or key in self.unused \
+                        or self.cache.contains(track_name, segment_idx, 'mp3'):
+                    continue
+                if self.unused_bytes >= self.budget:
+                    self._count('prefetch.over_budget')
+                    break
+                try:
+                    self.scheduled[key] = self.executor.submit(self._run, key)
+                except RuntimeError:
+                    # сервер останавливается, пул уже закрыт
+                    break
+                self._count('prefetch.scheduled')
+
+    def wait(self, track_name, segment_idx, timeout=None):
+        # сегмент уже готовится - дожидаемся его вместо повторного экспорта
+        with self._lock:
+            future = self.scheduled.get((track_name, segment_idx))
+        if future is None:
+            return None
+        try:
+            data = future.result(timeout)
+        except FutureTimeout:
+            return None
+        if data is not None:
+            self.consume(track_name, segment_idx)
+        return data
+
+    def _run(self, key):
+        try:
+            data = self.render(*key)
+        except Exception:
+            data = None
+        with self._lock:
+            self.scheduled.pop(key, None)
+            if data is not None:
+                self.unused[key] = len(data)
+                self.unused_bytes += len(data)
+        self._count('prefetch.done' if data is not None else 'prefetch.skipped')
+        return data
+
+    def _forget_evicted(self):
+        # то, что кэш уже вытеснил, бюджет не занимает
+        for key in [key for key in self.unused if not self.cache.contains(key[0], key[1], 'mp3')]:
+            self.unused_bytes -= self.unused.pop(key)
+
+    def invalidate(self, track_name):
+        with self._lock:
+            for key in [key for key in self.unused if key[0] == track_name]:
+                self.unused_bytes -= self.unused.pop(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self.depth,
+                'budget': self.budget,
+                'scheduled': len(self.scheduled),
+                'unused': len(self.unused),
+                'unused_bytes': self.unused_bytes
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
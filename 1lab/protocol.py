@@ -0,0 +1,137 @@
+import json
+import zlib
+import struct
+
+# заголовок кадра: тип, статус, id запроса, длина данных
+HEADER = struct.Struct('!BBIQ')
+HEADER_SIZE = HEADER.size
+
+# типы кадров
+TYPE_REQUEST = 1  # запрос клиента, данные - json с полем command
+TYPE_JSON = 2     # ответ в json
+TYPE_AUDIO = 3    # ответ с байтами аудио
+TYPE_END = 4      # конец потока кадров одного запроса (get_segments)
+TYPE_ZJSON = 5    # ответ в json, сжатый zlib
+
+# статусы ответа
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_RESTART = 2  # offset не подошел, данные отдаются с начала
+STATUS_BUSY = 3     # сервер перегружен, данные - json с retry_after в секундах
+
+MAX_REQUEST_SIZE = 1024 * 1024
+MAX_REQUEST_ID = 2 ** 32 - 1
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ServerBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'Сервер перегружен, повторить через {retry_after} с')
+        self.retry_after = retry_after
+
+
+def pack_header(frame_type, request_id, length, status=STATUS_OK):
+    return HEADER.pack(frame_type, status, request_id, length)
+
+
+def unpack_header(data):
+    frame_type, status, request_id, length = HEADER.unpack(data)
+    return frame_type, status, request_id, length
+
+
+def frame_parts(frame_type, request_id, payload=b'', status=STATUS_OK):
+    # заголовок и данные отдельно, чтобы не копировать большие куски аудио
+    return [pack_header(frame_type, request_id, len(payload), status), payload]
+
+
+def pack_frame(frame_type, request_id, payload=b'', status=STATUS_OK):
+    return b''.join(frame_parts(frame_type, request_id, payload, status))
+
+
+def json_frame_parts(request_id, obj, status=STATUS_OK):
+    payload = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    return frame_parts(TYPE_JSON, request_id, payload, status)
+
+
+def zjson_frame_parts(request_id, obj):
+    payload = zlib.compress(json.dumps(obj, ensure_ascii=False).encode('utf-8'))
+    return frame_parts(TYPE_ZJSON, request_id, payload)
+
+
+def decode_json(frame_type, payload):
+    if frame_type == TYPE_ZJSON:
+        payload = zlib.decompress(payload)
+    return json.loads(payload.decode('utf-8'))
+
+
+def error_frame_parts(request_id, message):
+    return json_frame_parts(request_id, {'error': message}, STATUS_ERROR)
+
+
+def busy_frame_parts(request_id, retry_after):
+    return json_frame_parts(request_id, {'error': 'Сервер перегружен', 'retry_after': retry_after}, STATUS_BUSY)
+
+
+def request_frame(request_id, command, **params):
+    params['command'] = command
+    payload = json.dumps(params, ensure_ascii=False).encode('utf-8')
+    return pack_frame(TYPE_REQUEST, request_id, payload)
+
+
+def decode_request(payload):
+    try:
+        request = json.loads(payload.decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        raise ProtocolError('Запрос не является json')
+    if not isinstance(request, dict) or 'command' not in request:
+        raise ProtocolError('В запросе нет команды')
+    return request
+
+
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if not count:
+            raise ConnectionError('Соединение закрыто посреди кадра')
+        received += count
+    return bytes(buffer)
+
+
+def recv_header(sock):
+    # None - соединение закрыто между кадрами
+    first = sock.recv(HEADER_SIZE)
+    if not first:
+        return None
+    if len(first) < HEADER_SIZE:
+        first += recv_exact(sock, HEADER_SIZE - len(first))
+    return unpack_header(first)
+
+
+def recv_frame(sock, max_size=None):
+    header = recv_header(sock)
+    if header is None:
+        return None
+    frame_type, status, request_id, length = header
+    if max_size is not None and length > max_size:
+        raise ProtocolError(f'Слишком большой кадр: {length} байт')
+    payload = recv_exact(sock, length) if length else b''
+    return frame_type, status, request_id, payload
+
+
+async def read_frame(reader, max_size=None):
+    data = await reader.read(HEADER_SIZE)
+    if not data:
+        return None
+    if len(data) < HEADER_SIZE:
+        data += await reader.readexactly(HEADER_SIZE - len(data))
+    frame_type, status, request_id, length = unpack_header(data)
+    if max_size is not None and length > max_size:
+        raise ProtocolError(f'Слишком большой кадр: {length} байт')
+    payload = await reader.readexactly(length) if length else b''
+    return frame_type, status, request_id, payload
@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+
+
+class SegmentCache:
+    # кэш уже закодированных сегментов, ключ - (трек, индекс сегмента, формат);
+    # поколение трека растет при каждом invalidate: экспорт, начатый со старой версии
+    # трека и закончившийся после обновления, в кэш уже не попадет
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_puts = 0
+        self._items = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, track_name):
+        # взять до чтения сегмента и передать в put
+        with self._lock:
+            return self._generations.get(track_name, 0)
+
+    def get(self, track_name, segment_idx, fmt='mp3'):
+        key = (track_name, segment_idx, fmt)
+        with self._lock:
+            data = self._items.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def contains(self, track_name, segment_idx, fmt='mp3'):
+        # без учета в hits/misses и без изменения порядка LRU
+        with self._lock:
+            return (track_name, segment_idx, fmt) in self._items
+
+    def put(self, track_name, segment_idx, data, fmt='mp3', generation=None):
+        # False - данные не сохранены: слишком большие или от старой версии трека
+        size = len(data)
+        if size > self.max_bytes:
+            return False
+        key = (track_name, segment_idx, fmt)
+        with self._lock:
+            if generation is not None and generation != self._generations.get(track_name, 0):
+                self.stale_puts += 1
+                return False
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old)
+            self._items[key] = data
+            self.current_bytes += size
+            # выкидываем самые давно использованные, пока не влезем в бюджет
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, track_name):
+        with self._lock:
+            self._generations[track_name] = self._generations.get(track_name, 0) + 1
+            for key in [key for key in self._items if key[0] == track_name]:
+                self.current_bytes -= len(self._items.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'items': len(self._items),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'stale_puts': self.stale_puts
+            }
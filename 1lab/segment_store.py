@@ -0,0 +1,145 @@
+import os
+import json
+import mmap
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+# кусок файла, который можно отдать через sendfile
+FileRegion = namedtuple('FileRegion', ['path', 'offset', 'length'])
+
+
+class SegmentStore:
+    # заранее закодированные сегменты: на трек один файл с сегментами подряд
+    # и индекс <ключ>.idx со смещениями и отметкой исходного файла;
+    # открытых mmap не больше max_maps: каждый держит открытый дескриптор файла
+    def __init__(self, root, max_maps=64):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+        self.max_maps = max_maps
+        self._indexes = {}
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def source_stamp(source_path):
+        stat = os.stat(source_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _key(self, track_name):
+        return hashlib.sha1(track_name.encode('utf-8')).hexdigest()
+
+    def _index_path(self, track_name):
+        return os.path.join(self.root, self._key(track_name) + '.idx')
+
+    def _read_index(self, track_name):
+        try:
+            with open(self._index_path(track_name), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, track_name, source_path):
+        # в памяти держим только индексы, совпавшие с исходным файлом
+        index = self._read_index(track_name)
+        try:
+            fresh = index is not None and index['source'] == self.source_stamp(source_path)
+        except OSError:
+            fresh = False
+        with self._lock:
+            if fresh:
+                old = self._indexes.get(track_name)
+                self._indexes[track_name] = index
+                if old is not None and old['data'] != index['data']:
+                    # сегменты перерендерили в другом процессе
+                    mapped = self._maps.pop(os.path.join(self.root, old['data']), None)
+                    if mapped is not None:
+                        self._close(mapped)
+            else:
+                self._indexes.pop(track_name, None)
+        return fresh
+
+    def render(self, track_name, source_path, segments):
+        # segments - итератор байт уже закодированных сегментов
+        stamp = self.source_stamp(source_path)
+        data_name = f'{self._key(track_name)}-{stamp[0]}-{stamp[1]}.seg'
+        data_path = os.path.join(self.root, data_name)
+        offsets = []
+        offset = 0
+        with open(data_path + '.tmp', 'wb') as f:
+            for data in segments:
+                f.write(data)
+                offsets.append([offset, len(data)])
+                offset += len(data)
+        os.replace(data_path + '.tmp', data_path)
+
+        old = self._read_index(track_name)
+        index = {'track': track_name, 'source': stamp, 'data': data_name, 'segments': offsets}
+        index_path = self._index_path(track_name)
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(index_path + '.tmp', index_path)
+
+        with self._lock:
+            self._indexes[track_name] = index
+        if old is not None and old['data'] != data_name:
+            self._remove_data(old['data'])
+
+    def locate(self, track_name, segment_idx):
+        with self._lock:
+            index = self._indexes.get(track_name)
+        if index is None or not 0 <= segment_idx < len(index['segments']):
+            return None
+        offset, length = index['segments'][segment_idx]
+        return FileRegion(os.path.join(self.root, index['data']), offset, length)
+
+    def owns(self, path):
+        return os.path.dirname(path) == self.root
+
+    def view(self, stored):
+        # memoryview поверх mmap, данные не копируются в python
+        with self._lock:
+            mapped = self._maps.get(stored.path)
+            if mapped is None:
+                with open(stored.path, 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[stored.path] = mapped
+                while len(self._maps) > self.max_maps:
+                    self._close(self._maps.popitem(last=False)[1])
+            else:
+                self._maps.move_to_end(stored.path)
+        return memoryview(mapped)[stored.offset:stored.offset + stored.length]
+
+    @staticmethod
+    def _close(mapped):
+        # пока сегмент из mmap еще отправляется, закрыть нельзя - тогда mmap
+        # закроется сам, когда с него уйдут все memoryview
+        try:
+            mapped.close()
+        except BufferError:
+            pass
+
+    def invalidate(self, track_name):
+        with self._lock:
+            self._indexes.pop(track_name, None)
+
+    def remove(self, track_name):
+        index = self._read_index(track_name)
+        self.invalidate(track_name)
+        try:
+            os.unlink(self._index_path(track_name))
+        except OSError:
+            pass
+        if index is not None:
+            self._remove_data(index['data'])
+
+    def _remove_data(self, data_name):
+        path = os.path.join(self.root, data_name)
+        with self._lock:
+            mapped = self._maps.pop(path, None)
+        if mapped is not None:
+            self._close(mapped)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
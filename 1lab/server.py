@@ -1,26 +1,174 @@
 from pydub import AudioSegment
 import os
+import time
+import wave
+import argparse
 import json
+import zlib
 import socket
+import select
 import threading
-import io
+import asyncio
+from collections import OrderedDict, deque
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import logging
+import itertools
+from contextlib import contextmanager
+from segment_cache import SegmentCache
+from segment_store import SegmentStore, FileRegion
+from catalog import Catalog, CatalogSnapshot
+from ingest import ingest_file, split_segments, export_segment
+from mp3_index import FrameIndex, index_path
+from peaks import PeakPyramid, peaks_path
+from prefetch import Prefetcher
+from metrics import Metrics
+from sharding import HashRing
+from protocol import (
+    TYPE_REQUEST, TYPE_AUDIO, TYPE_END, STATUS_OK, STATUS_ERROR, STATUS_RESTART, STATUS_BUSY,
+    MAX_REQUEST_SIZE, ProtocolError, ServerBusy, pack_header, unpack_header, frame_parts,
+    json_frame_parts, zjson_frame_parts, error_frame_parts, busy_frame_parts, decode_request,
+    recv_frame, read_frame, TYPE_JSON, TYPE_ZJSON
+)
 
 class Server:
-    def __init__(self, host='localhost', port=8899, audio_folder='audio'):
+    # команды, которые нельзя выполнять прямо в event loop
+    BLOCKING_COMMANDS = ('refresh', 'get_part_of_audio', 'get_range', 'get_peaks')
+    # команды, отвечающие потоком кадров, который завершает кадр TYPE_END
+    STREAMING_COMMANDS = ('get_segments',)
+    # сколько запросов одного клиента asyncio режим выполняет одновременно
+    PIPELINE_DEPTH = 32
+    # как часто при загрузке публиковать промежуточный каталог и писать прогресс
+    PUBLISH_INTERVAL = 0.5
+    PROGRESS_EVERY = 10
+    # сколько индексов кадров mp3 держать в памяти
+    FRAME_INDEX_CACHE = 256
+    # сколько пирамид пиков держать в памяти и сколько столбиков отдавать за раз
+    PEAK_CACHE = 256
+    MAX_PEAK_BINS = 10000
+    # больше стольких треков на одной странице каталога не отдаем
+    MAX_PAGE_SIZE = 1000
+    # сколько последних изменений каталога помнить для ответов since
+    CHANGE_HISTORY = 256
+    # параметры, с которыми get_metadata и get_audio_list отвечают страницей
+    CATALOG_QUERY = ('cursor', 'limit', 'prefix', 'contains', 'fields', 'since')
+    # через сколько секунд клиенту предлагается повторить запрос при перегрузке
+    RETRY_AFTER = 0.5
+    # команды, которые меняют состояние соединения, а не просто отвечают
+    SUBSCRIPTION_COMMANDS = ('subscribe', 'unsubscribe')
+    # команды, по которым ведутся метрики; остальные считаются как unknown
+    COMMANDS = ('get_metadata', 'stats', 'refresh', 'get_audio_list',
+                'get_part_of_audio', 'get_range', 'get_segments', 'subscribe', 'unsubscribe',
+                'get_peaks')
+
+    def __init__(self, host='localhost', port=8899, audio_folder='audio',
+                 lazy=False, segment_length=6000, cache_size=64 * 1024 * 1024,
+                 export_workers=None, prerender=False, store_folder='segments',
+                 catalog_file='audio_metadata.json', ingest_workers=None,
+                 frames_folder='frames', log_level=logging.DEBUG, log_every=1,
+                 metrics_file=None, metrics_interval=10, watch=False, watch_interval=2.0,
+                 max_connections=256, export_queue=None, idle_timeout=300, io_timeout=30,
+                 backlog=128, peaks=False, peaks_folder='peaks', prefetch_depth=2,
+                 prefetch_budget=16 * 1024 * 1024, shard_nodes=None, shard_node=None, replicas=2):
         self.host = host
         self.port = port
+        # shard_nodes - все узлы кластера (host:port); каждый узел загружает только
+        # треки, которые кольцо отдает ему (основному или одной из replicas реплик)
+        self.ring = HashRing(shard_nodes, replicas) if shard_nodes else None
+        self.shard_node = shard_node or f'{host}:{port}'
+        if self.ring is not None and self.shard_node not in self.ring.nodes:
+            raise ValueError(f'Узла {self.shard_node} нет в списке узлов кластера')
         current_dir = os.path.dirname(os.path.abspath(__file__))
         self.audio_folder = os.path.join(current_dir, audio_folder)
-        self.track_info = {}
-        self.track_segments = {}
+        # lazy - при старте только читаем заголовки, сегменты декодируем по запросу
+        self.lazy = lazy
+        self.segment_length = segment_length
+        # каталог на диске и опубликованный снимок для обработчиков
+        self.catalog = Catalog(os.path.join(current_dir, catalog_file))
+        self.snapshot = CatalogSnapshot.build(self.catalog.version, {}, {})
+        self.refresh_lock = threading.Lock()
+        # (версия, изменены, удалены) по версиям - для ответов since
+        self.catalog_changes = deque(maxlen=self.CHANGE_HISTORY)
+        # закодированный каталог целиком, пока не сменился снимок
+        self.catalog_payloads = {}
+        self.catalog_payloads_snapshot = None
+        self.catalog_payloads_lock = threading.Lock()
+        # cache_size - бюджет кэша готовых mp3 сегментов в байтах, 0 - без кэша
+        self.segment_cache = SegmentCache(cache_size) if cache_size > 0 else None
         self.socket = None
         self.is_running = False
+        # для asyncio режима
+        self.export_workers = export_workers or os.cpu_count()
+        # ограничения под нагрузкой: лишним соединениям и экспортам сразу отвечаем
+        # "занято, повторите позже", а не копим потоки и очередь без предела
+        self.max_connections = max_connections
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        self.connection_count = 0
+        self.export_slots = threading.BoundedSemaphore(self.export_workers)
+        self.export_queue = export_queue if export_queue is not None else self.export_workers * 4
+        self.export_waiting = 0
+        self.export_lock = threading.Lock()
+        self.executor_pending = 0
+        # idle_timeout - сколько ждать следующего запроса, io_timeout - чтения/записи кадра
+        self.idle_timeout = idle_timeout
+        self.io_timeout = io_timeout
+        self.backlog = backlog
+        self.loop = None
+        self.executor = None
+        self.async_server = None
+        # prerender - при загрузке складываем готовые сегменты на диск и отдаем через sendfile
+        self.segment_store = None
+        if prerender:
+            self.segment_store = SegmentStore(os.path.join(current_dir, store_folder))
+        # индексы кадров mp3 для get_range
+        self.frames_root = os.path.join(current_dir, frames_folder)
+        os.makedirs(self.frames_root, exist_ok=True)
+        self.frame_indexes = OrderedDict()
+        self.frame_indexes_lock = threading.Lock()
+        # пирамиды пиков для get_peaks; peaks - считать их при загрузке, а не по запросу
+        self.peaks = peaks
+        self.peaks_root = os.path.join(current_dir, peaks_folder)
+        os.makedirs(self.peaks_root, exist_ok=True)
+        self.peak_pyramids = OrderedDict()
+        self.peak_pyramids_lock = threading.Lock()
+        # загрузка библиотеки в несколько процессов
+        self.ingest_workers = ingest_workers if ingest_workers is not None else os.cpu_count()
+        self.ingest_done = threading.Event()
+        self.ingest_progress = {'done': 0, 'total': 0, 'errors': 0}
+        self.ingest_errors = {}
+        # watch - опрашивать папку и подхватывать изменения без refresh
+        self.watch = watch
+        self.watch_interval = watch_interval
+        self.watch_stop = threading.Event()
+        # подписчики на изменения каталога: id -> функция отправки события
+        self.subscribers = {}
+        self.subscribers_lock = threading.Lock()
+        self.subscriber_ids = itertools.count(1)
+        # счетчики и гистограммы задержек, читаются командой stats
+        self.metrics = Metrics()
+        # при последовательном чтении следующие prefetch_depth сегментов готовятся заранее;
+        # результат кладется в кэш сегментов, поэтому без кэша предзагрузки нет
+        self.prefetcher = None
+        if prefetch_depth > 0 and self.segment_cache is not None:
+            self.prefetcher = Prefetcher(
+                self.segment_cache,
+                self.prefetch_segment,
+                depth=prefetch_depth,
+                budget=prefetch_budget,
+                workers=max(1, self.export_workers // 2),
+                metrics=self.metrics
+            )
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.metrics_stop = threading.Event()
+        # log_every - писать в лог каждый n-й запрос, 0 - не писать запросы совсем
+        self.log_every = log_every
+        self.request_log_counter = itertools.count()
         logs_dir = os.path.join(current_dir, 'logs')
         os.makedirs(logs_dir, exist_ok=True)
         log_path = os.path.join(logs_dir, 'server.log')
         logging.basicConfig(
-            level=logging.DEBUG,
+            level=log_level,
             format='%(asctime)s - %(levelname)s - %(message)s',
             handlers=[
                 logging.FileHandler(log_path, encoding='utf-8'),
@@ -31,138 +179,1199 @@ class Server:
         self.log.info('Сервер начинает работу')
         self.log.info(f'Аудио файлы: {self.audio_folder}')
         self.log.info(f'Файлы для логов: {logs_dir}')
-        self.load_audio_files()
+        if self.lazy:
+            self.log.info('Ленивый режим: сегменты декодируются по запросу')
+        if self.ring is not None:
+            self.log.info(f'Узел {self.shard_node} из {len(self.ring.nodes)}, реплик {self.ring.replicas}')
+        if self.metrics_file:
+            threading.Thread(target=self.dump_metrics_loop, daemon=True).start()
+        self.start_ingest()
+        if self.watch:
+            self.log.info(f'Слежение за папкой, период {self.watch_interval} с')
+            threading.Thread(target=self.watch_loop, daemon=True).start()
+
+    def log_request(self, message, *args):
+        # лог на каждый запрос дорог на горячем пути, поэтому выборочно;
+        # аргументы форматируются, только если запись действительно пишется
+        if self.log_every and next(self.request_log_counter) % self.log_every == 0:
+            self.log.debug(message, *args)
+
+    def stats(self):
+        result = self.metrics.snapshot()
+        result['cache'] = self.segment_cache.stats() if self.segment_cache is not None else None
+        result['catalog'] = {'version': self.snapshot.version, 'tracks': len(self.track_info)}
+        result['ingest'] = dict(self.ingest_progress)
+        result['prefetch'] = self.prefetcher.stats() if self.prefetcher is not None else None
+        result['shard'] = self.shard_info()
+        result['admission'] = {
+            'max_connections': self.max_connections,
+            'export_workers': self.export_workers,
+            'export_queue': self.export_queue,
+            'export_waiting': self.export_waiting,
+            'executor_pending': self.executor_pending
+        }
+        return result
+
+    def metrics_extra(self):
+        # значения, которые хранятся не в Metrics, для текстового дампа
+        extra = {
+            'catalog.version': self.snapshot.version,
+            'catalog.tracks': len(self.track_info)
+        }
+        if self.segment_cache is not None:
+            for key, value in self.segment_cache.stats().items():
+                extra[f'cache.{key}'] = value
+        for key, value in self.ingest_progress.items():
+            extra[f'ingest.{key}'] = value
+        return extra
+
+    def dump_metrics_loop(self):
+        while not self.metrics_stop.wait(self.metrics_interval):
+            try:
+                self.metrics.dump(self.metrics_file, self.metrics_extra())
+            except OSError as e:
+                self.log.error(f'Не удалось записать метрики: {e}')
+
+    def record_request(self, cmd, started, parts):
+        cmd = cmd if cmd in self.COMMANDS else 'unknown'
+        self.metrics.observe(f'latency.{cmd}', time.perf_counter() - started)
+        self.metrics.inc(f'requests.{cmd}')
+        status = unpack_header(parts[0])[1] if parts else STATUS_OK
+        if status == STATUS_ERROR:
+            self.metrics.inc(f'errors.{cmd}')
+        elif status == STATUS_BUSY:
+            self.metrics.inc(f'busy.{cmd}')
+
+    @contextmanager
+    def export_slot(self):
+        # не больше export_workers экспортов сразу и не больше export_queue в очереди
+        if not self.export_slots.acquire(blocking=False):
+            with self.export_lock:
+                if self.export_waiting >= self.export_queue:
+                    self.metrics.inc('rejected.export')
+                    raise ServerBusy(self.RETRY_AFTER)
+                self.export_waiting += 1
+            try:
+                acquired = self.export_slots.acquire(timeout=self.io_timeout)
+            finally:
+                with self.export_lock:
+                    self.export_waiting -= 1
+            if not acquired:
+                self.metrics.inc('rejected.export')
+                raise ServerBusy(self.RETRY_AFTER)
+        try:
+            yield
+        finally:
+            self.export_slots.release()
+
+    def busy_parts(self, request_id, busy):
+        self.log.warning(f'Запрос #{request_id} отклонен: {busy}')
+        return busy_frame_parts(request_id, busy.retry_after)
+
+    @staticmethod
+    def parts_size(parts):
+        return sum(part.length if isinstance(part, FileRegion) else len(part) for part in parts)
+
+    def start_ingest(self):
+        # сервер начинает отвечать сразу, треки появляются по мере обработки
+        threading.Thread(target=self.load_audio_files, daemon=True).start()
+
+    def wait_ready(self, timeout=None):
+        return self.ingest_done.wait(timeout)
+
+    def shard_info(self):
+        return self.ring.describe(self.shard_node) if self.ring is not None else None
+
+    def owns_track(self, track_name):
+        return self.ring is None or self.ring.owns(self.shard_node, track_name)
+
+    def folder_signature(self):
+        # имена, размеры и mtime аудио файлов; дешевле, чем сам проход загрузки
+        signature = []
+        for dir_entry in os.scandir(self.audio_folder):
+            if dir_entry.is_file() and dir_entry.name.endswith(('.mp3', '.wav')) \
+                    and self.owns_track(dir_entry.name):
+                try:
+                    stat = dir_entry.stat()
+                except OSError:
+                    continue
+                signature.append((dir_entry.name, stat.st_size, stat.st_mtime_ns))
+        return sorted(signature)
+
+    def watch_loop(self):
+        # inotify нет в стандартной библиотеке, поэтому опрос; загрузка запускается,
+        # когда папка изменилась и не менялась еще один период (файл докопировали)
+        self.wait_ready()
+        loaded = None
+        seen = None
+        while not self.watch_stop.wait(self.watch_interval):
+            try:
+                current = self.folder_signature()
+            except OSError as e:
+                self.log.error(f'Не удалось прочитать папку: {e}')
+                continue
+            if current != seen:
+                seen = current
+                continue
+            if current != loaded:
+                self.load_audio_files()
+                loaded = current
+
+    def subscribe(self, send_event):
+        with self.subscribers_lock:
+            token = next(self.subscriber_ids)
+            self.subscribers[token] = send_event
+        self.metrics.add_gauge('subscribers', 1)
+        return token
+
+    def unsubscribe(self, token):
+        with self.subscribers_lock:
+            removed = self.subscribers.pop(token, None)
+        if removed is not None:
+            self.metrics.add_gauge('subscribers', -1)
+
+    def notify_subscribers(self, event):
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers.items())
+        for token, send_event in subscribers:
+            try:
+                send_event(event)
+                self.metrics.inc('notifications')
+            except (OSError, RuntimeError):
+                self.unsubscribe(token)
+
+    def handle_subscription(self, cmd, request_id, token, send_event):
+        # (id подписки соединения или None, ответ); на соединение одна подписка,
+        # события приходят кадрами TYPE_JSON с request_id запроса subscribe
+        if token is not None:
+            self.unsubscribe(token)
+            token = None
+        if cmd == 'subscribe':
+            token = self.subscribe(lambda event: send_event(request_id, event))
+            return token, json_frame_parts(request_id, {'status': 'subscribed', 'version': self.snapshot.version})
+        return token, json_frame_parts(request_id, {'status': 'unsubscribed'})
 
     def load_audio_files(self):
-        self.track_info = {}
-        self.track_segments = {}
-        for file in os.listdir(self.audio_folder):
-            if file.endswith(('.mp3', '.wav')):
-                full_path = os.path.join(self.audio_folder, file)
+        with self.refresh_lock:
+            self.ingest_done.clear()
+            try:
+                return self.ingest_audio_files()
+            finally:
+                self.ingest_done.set()
+
+    def ingest_audio_files(self):
+        # обрабатываем только новые, измененные и удаленные файлы,
+        # обработчики запросов видят либо старый снимок каталога, либо новый целиком
+        old = self.snapshot
+        catalog = self.catalog
+        resegment = catalog.segment_length != self.segment_length
+        store_root = self.segment_store.root if self.segment_store is not None else None
+        track_info = {}
+        track_segments = {}
+        present = set()
+        jobs = []
+        for dir_entry in os.scandir(self.audio_folder):
+            file = dir_entry.name
+            if not dir_entry.is_file() or not file.endswith(('.mp3', '.wav')):
+                continue
+            # чужие треки не загружаем; если узлы добавились, ушедшие треки удалятся из каталога
+            if not self.owns_track(file):
+                continue
+            present.add(file)
+            entry = catalog.tracks.get(file)
+            segments = old.track_segments.get(file)
+            try:
+                unchanged = catalog.is_unchanged(file, dir_entry.stat()) and not resegment
+            except OSError:
+                unchanged = False
+            decode = not self.lazy and (segments is None or not unchanged)
+            render = store_root is not None and not self.segment_store.is_fresh(file, dir_entry.path)
+            build_peaks = self.peaks and not self.peaks_fresh(file, dir_entry.path)
+            if unchanged and not decode and not render and not build_peaks:
+                track_info[file] = entry
+                if segments is not None:
+                    track_segments[file] = segments
+                continue
+
+            # пока файл обрабатывается, клиенты видят его прежнюю версию
+            if file in old.track_info:
+                track_info[file] = old.track_info[file]
+                if segments is not None:
+                    track_segments[file] = segments
+            jobs.append({
+                'name': file,
+                'path': dir_entry.path,
+                'segment_length': self.segment_length,
+                'entry': entry,
+                'check_hash': not unchanged,
+                'decode': decode,
+                'prerender_root': store_root if render else None,
+                'frames_root': self.frames_root,
+                'peaks_root': self.peaks_root if self.peaks else None
+            })
+
+        version = catalog.version
+        self.snapshot = CatalogSnapshot.build(version, dict(track_info), dict(track_segments))
+
+        changed = []
+        errors = {}
+        self.ingest_progress = {'done': 0, 'total': len(jobs), 'errors': 0}
+        if jobs:
+            self.log.info(f'Обработка {len(jobs)} файлов, процессов: {self.ingest_workers}')
+        last_publish = time.monotonic()
+        for done, result in enumerate(self.run_ingest_jobs(jobs), 1):
+            file = result['name']
+            if result['error']:
+                errors[file] = result['error']
+                self.log.error(f'Не удалось загрузить {file}: {result["error"]}')
+                if result.get('traceback'):
+                    self.log.debug(result['traceback'])
+                track_info.pop(file, None)
+                track_segments.pop(file, None)
+            else:
+                track_info[file] = result['entry']
+                if result['audio'] is not None:
+                    track_segments[file] = split_segments(result['audio'], self.segment_length)
+                if result['changed']:
+                    changed.append(file)
+                if store_root is not None:
+                    self.segment_store.is_fresh(file, os.path.join(self.audio_folder, file))
+            self.ingest_progress = {'done': done, 'total': len(jobs), 'errors': len(errors)}
+            if done % self.PROGRESS_EVERY == 0 or done == len(jobs):
+                self.log.info(f'Обработано {done}/{len(jobs)}, ошибок: {len(errors)}')
+            if time.monotonic() - last_publish >= self.PUBLISH_INTERVAL:
+                self.snapshot = CatalogSnapshot.build(version, dict(track_info), dict(track_segments))
+                last_publish = time.monotonic()
+
+        removed = [name for name in set(catalog.tracks) | set(old.track_info) if name not in present]
+        if changed or removed:
+            version += 1
+            self.catalog_changes.append((version, changed, removed))
+        self.snapshot = CatalogSnapshot.build(version, track_info, track_segments)
+        self.ingest_errors = errors
+
+        if self.segment_cache is not None:
+            for track_name in changed + removed:
+                self.segment_cache.invalidate(track_name)
+                if self.prefetcher is not None:
+                    self.prefetcher.invalidate(track_name)
+        with self.frame_indexes_lock:
+            for track_name in changed + removed:
+                self.frame_indexes.pop(track_name, None)
+        with self.peak_pyramids_lock:
+            for track_name in changed + removed:
+                self.peak_pyramids.pop(track_name, None)
+        if self.segment_store is not None:
+            for track_name in removed:
+                self.segment_store.remove(track_name)
+
+        if track_info != catalog.tracks or version != catalog.version or resegment:
+            catalog.tracks = track_info
+            catalog.version = version
+            catalog.segment_length = self.segment_length
+            catalog.save()
+        self.log.info(f'Каталог v{version}: добавлено или изменено {len(changed)}, удалено {len(removed)}')
+        if changed or removed:
+            # отправка идет в своем потоке, медленный подписчик не задерживает загрузку
+            threading.Thread(target=self.notify_subscribers, args=({
+                'event': 'catalog_changed',
+                'version': version,
+                'changed': changed,
+                'removed': removed
+            },), daemon=True).start()
+        return changed, removed, errors
+
+    def run_ingest_jobs(self, jobs):
+        if self.ingest_workers <= 1:
+            for job in jobs:
+                yield ingest_file(job)
+            return
+        with ProcessPoolExecutor(max_workers=self.ingest_workers) as pool:
+            futures = {pool.submit(ingest_file, job): job['name'] for job in jobs}
+            for future in as_completed(futures):
                 try:
-                    audio = AudioSegment.from_file(full_path)
-                    segments = []
-                    segment_length = 6000  # 6 секунд
-
-                    # аудио на сегменты
-                    for start_ms in range(0, len(audio), segment_length):
-                        segment = audio[start_ms:start_ms + segment_length]
-                        segments.append(segment)
-
-                    self.track_info[file] = {
-                        'name': file,
-                        'duration': len(audio) / 1000
-                    }
-                    self.track_segments[file] = segments
-                except Exception:
-                    pass
-
-        with open('audio_metadata.json', 'w', encoding='utf-8') as f:
-            json.dump(self.track_info, f, ensure_ascii=False, indent=4)
+                    yield future.result()
+                except Exception as e:
+                    # упал сам процесс, а не разбор файла
+                    yield {'name': futures[future], 'error': f'{type(e).__name__}: {e}'}
+
+    @property
+    def track_info(self):
+        return self.snapshot.track_info
+
+    @property
+    def track_segments(self):
+        return self.snapshot.track_segments
 
     def run(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.bind((self.host, self.port))
-        self.socket.listen(3)
+        self.socket.listen(self.backlog)
         self.is_running = True
         print(f'Сервер стартанул, {self.host}:{self.port}')
         while self.is_running:
             try:
                 conn, addr = self.socket.accept()
+                # заголовок и данные уходят разными send, без этого ответ ждет delayed ACK
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if not self.connection_slots.acquire(blocking=False):
+                    self.reject_connection(conn)
+                    continue
                 client_thread = threading.Thread(
-                    target=self.process_client,
-                    args=(conn,)
+                    target=self.serve_connection,
+                    args=(conn,),
+                    daemon=True
                 )
                 client_thread.start()
             except Exception as e:
                 print(f'Ошибка: {e}')
 
-    def cut_audio(self, track_name, segment_idx):
+    def reject_connection(self, conn):
+        # кадр с request_id 0: соединение закрывается, клиенту переподключиться позже
+        self.metrics.inc('rejected.connections')
+        self.log.warning(f'Достигнут предел соединений {self.max_connections}')
+        try:
+            conn.settimeout(1)
+            self.send_parts(conn, busy_frame_parts(0, self.RETRY_AFTER))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def serve_connection(self, conn):
         try:
+            self.process_client(conn)
+        finally:
+            self.connection_slots.release()
+
+    def segment_count(self, track_name):
+        info = self.track_info.get(track_name)
+        if info is None:
+            return 0
+        return info['segments']
+
+    def get_segment(self, track_name, segment_idx):
+        if not self.lazy:
             segments = self.track_segments.get(track_name)
             if segments and 0 <= segment_idx < len(segments):
-                segment = segments[segment_idx]
-                buffer = io.BytesIO()
-                segment.export(buffer, format='mp3')
-                result = buffer.getvalue()
+                return segments[segment_idx]
+            return None
+
+        if not 0 <= segment_idx < self.segment_count(track_name):
+            return None
+        full_path = os.path.join(self.audio_folder, track_name)
+        start_ms = segment_idx * self.segment_length
+        if full_path.endswith('.wav'):
+            try:
+                with wave.open(full_path, 'rb') as wav:
+                    rate = wav.getframerate()
+                    wav.setpos(int(start_ms * rate / 1000))
+                    data = wav.readframes(int(self.segment_length * rate / 1000))
+                    return AudioSegment(
+                        data=data,
+                        sample_width=wav.getsampwidth(),
+                        frame_rate=rate,
+                        channels=wav.getnchannels()
+                    )
+            except wave.Error:
+                pass
+        # ffmpeg декодирует только нужный кусок файла
+        return AudioSegment.from_file(
+            full_path,
+            start_second=start_ms / 1000,
+            duration=self.segment_length / 1000
+        )
+
+    def get_frame_index(self, track_name):
+        with self.frame_indexes_lock:
+            frame_index = self.frame_indexes.get(track_name)
+            if frame_index is not None:
+                self.frame_indexes.move_to_end(track_name)
+                return frame_index
+        full_path = os.path.join(self.audio_folder, track_name)
+        path = index_path(self.frames_root, track_name)
+        stamp = SegmentStore.source_stamp(full_path)
+        frame_index = FrameIndex.load(path, stamp)
+        if frame_index is None:
+            # индекса нет или он устарел - строим один раз и сохраняем
+            frame_index = FrameIndex.build(full_path)
+            frame_index.save(path, stamp)
+        with self.frame_indexes_lock:
+            self.frame_indexes[track_name] = frame_index
+            while len(self.frame_indexes) > self.FRAME_INDEX_CACHE:
+                self.frame_indexes.popitem(last=False)
+        return frame_index
+
+    def peaks_fresh(self, track_name, full_path):
+        try:
+            stamp = SegmentStore.source_stamp(full_path)
+        except OSError:
+            return False
+        return PeakPyramid.is_fresh(peaks_path(self.peaks_root, track_name), stamp)
+
+    def get_peaks(self, track_name):
+        # с диска, если пирамида построена для этой версии файла, иначе строим сейчас
+        with self.peak_pyramids_lock:
+            pyramid = self.peak_pyramids.get(track_name)
+            if pyramid is not None:
+                self.peak_pyramids.move_to_end(track_name)
+                return pyramid
+        full_path = os.path.join(self.audio_folder, track_name)
+        path = peaks_path(self.peaks_root, track_name)
+        stamp = SegmentStore.source_stamp(full_path)
+        pyramid = PeakPyramid.load(path, stamp)
+        if pyramid is None:
+            with self.export_slot():
+                pyramid = PeakPyramid.from_audio(AudioSegment.from_file(full_path))
+            pyramid.save(path, stamp)
+        with self.peak_pyramids_lock:
+            self.peak_pyramids[track_name] = pyramid
+            while len(self.peak_pyramids) > self.PEAK_CACHE:
+                self.peak_pyramids.popitem(last=False)
+        return pyramid
+
+    def peaks_response(self, request):
+        # level - уровень пирамиды; без него выбирается по width (сколько столбиков нужно)
+        track_name = request.get('file_name')
+        info = self.track_info.get(track_name)
+        if info is None:
+            raise ValueError(f'Нет такого файла: {track_name}')
+        duration_ms = info['duration'] * 1000
+        start_ms = request.get('start_ms', 0)
+        end_ms = request.get('end_ms', duration_ms)
+        level = request.get('level')
+        width = request.get('width', 1000)
+        if not isinstance(start_ms, (int, float)) or not isinstance(end_ms, (int, float)) \
+                or start_ms < 0 or end_ms <= start_ms:
+            raise ValueError('Нужен диапазон 0 <= start_ms < end_ms')
+        if level is not None and not isinstance(level, int):
+            raise ValueError('level должен быть целым')
+        if not isinstance(width, int) or width <= 0:
+            raise ValueError('width должен быть положительным целым')
+        pyramid = self.get_peaks(track_name)
+        if level is None:
+            level = pyramid.level_for_width(start_ms, end_ms, min(width, self.MAX_PEAK_BINS))
+        if not 0 <= level < len(pyramid.levels):
+            raise ValueError(f'level должен быть от 0 до {len(pyramid.levels) - 1}')
+        if (end_ms - start_ms) / pyramid.bin_ms(level) > self.MAX_PEAK_BINS:
+            raise ValueError(f'Больше {self.MAX_PEAK_BINS} столбиков, нужен уровень грубее')
+        return pyramid.query(level, start_ms, min(end_ms, duration_ms))
+
+    def cut_range(self, track_name, start_ms, end_ms):
+        # mp3 режется по границам кадров без перекодирования, остальное - через ffmpeg
+        try:
+            full_path = os.path.join(self.audio_folder, track_name)
+            if track_name.endswith('.mp3'):
+                byte_range = self.get_frame_index(track_name).byte_range(start_ms, end_ms)
+                if byte_range is None:
+                    return None
+                return FileRegion(full_path, byte_range[0], byte_range[1])
+            audio = AudioSegment.from_file(
+                full_path,
+                start_second=start_ms / 1000,
+                duration=(end_ms - start_ms) / 1000
+            )
+            if not len(audio):
+                return None
+            started = time.perf_counter()
+            with self.export_slot():
+                result = export_segment(audio)
+            self.metrics.observe('export_range', time.perf_counter() - started)
+            return result
+        except ServerBusy:
+            raise
+        except Exception as e:
+            self.log.error(f'Ошибка при вырезании диапазона: {str(e)}', exc_info=True)
+            return None
+
+    def read_region(self, region):
+        if self.segment_store is not None and self.segment_store.owns(region.path):
+            return self.segment_store.view(region)
+        with open(region.path, 'rb') as f:
+            f.seek(region.offset)
+            return f.read(region.length)
+
+    def find_stored_segment(self, track_name, segment_idx):
+        if self.segment_store is None or not isinstance(segment_idx, int):
+            return None
+        return self.segment_store.locate(track_name, segment_idx)
+
+    def prefetch_segment(self, track_name, segment_idx):
+        # для Prefetcher: только если есть свободный поток экспорта,
+        # запросы клиентов важнее предзагрузки
+        if self.find_stored_segment(track_name, segment_idx) is not None:
+            return None
+        if not self.export_slots.acquire(blocking=False):
+            return None
+        try:
+            generation = self.segment_cache.generation(track_name)
+            segment = self.get_segment(track_name, segment_idx)
+            if segment is None:
+                return None
+            started = time.perf_counter()
+            result = export_segment(segment)
+            self.metrics.observe('export_prefetch', time.perf_counter() - started)
+        finally:
+            self.export_slots.release()
+        # трек обновился, пока шел экспорт - старые данные не отдаем и не кэшируем
+        if not self.segment_cache.put(track_name, segment_idx, result, 'mp3', generation):
+            return None
+        return result
+
+    def cut_audio(self, track_name, segment_idx):
+        try:
+            if self.segment_cache is not None:
+                cached = self.segment_cache.get(track_name, segment_idx, 'mp3')
+                if cached is not None:
+                    return cached
+            if self.prefetcher is not None:
+                prefetched = self.prefetcher.wait(track_name, segment_idx, self.io_timeout)
+                if prefetched is not None:
+                    return prefetched
+            if self.segment_cache is not None:
+                generation = self.segment_cache.generation(track_name)
+            segment = self.get_segment(track_name, segment_idx)
+            if segment is not None:
+                started = time.perf_counter()
+                with self.export_slot():
+                    result = export_segment(segment)
+                self.metrics.observe('export', time.perf_counter() - started)
+                if self.segment_cache is not None:
+                    self.segment_cache.put(track_name, segment_idx, result, 'mp3', generation)
                 return result
             else:
                 self.log.error(f'Ошибка: неверный индекс сегмента для {track_name}')
                 return None
+        except ServerBusy:
+            raise
         except Exception as e:
             self.log.error(f'Ошибка при обработке аудио: {str(e)}', exc_info=True)
             return None
 
+    def parse_request(self, frame_type, payload):
+        if frame_type != TYPE_REQUEST:
+            raise ProtocolError(f'Неожиданный тип кадра: {frame_type}')
+        request = decode_request(payload)
+        return request['command'], request
+
+    def handle_command(self, cmd, request, request_id, access=None):
+        # список кусков байт ответа (заголовок кадра + данные);
+        # access - история чтения треков этим соединением для предзагрузки
+        if cmd == 'get_metadata':
+            self.log_request('Отправка метаданных')
+            return self.catalog_parts(cmd, request, request_id)
+
+        elif cmd == 'stats':
+            # format=text - тот же плоский текст, что пишется в metrics_file
+            if request.get('format') == 'text':
+                return json_frame_parts(request_id, {'text': self.metrics.render_text(self.metrics_extra())})
+            return json_frame_parts(request_id, self.stats())
+
+        elif cmd == 'refresh':
+            self.log.debug('Обновление метаданных')
+            if request.get('wait', True) is False:
+                # загрузка в фоне, о результате сообщат подписчикам
+                self.start_ingest()
+                return json_frame_parts(request_id, {'status': 'started', 'version': self.snapshot.version})
+            changed, removed, errors = self.load_audio_files()
+            return json_frame_parts(request_id, {
+                'status': 'refreshed',
+                'version': self.snapshot.version,
+                'changed': changed,
+                'removed': removed,
+                'errors': errors
+            })
+
+        elif cmd == 'get_audio_list':
+            self.log_request('Отправка списка аудио')
+            return self.catalog_parts(cmd, request, request_id)
+
+        elif cmd == 'get_part_of_audio':
+            track_name = request.get('file_name')
+            segment_idx = request.get('segment_idx')
+            # offset и size - докачка: с какого байта и какой размер сегмента был
+            offset = request.get('offset', 0)
+            expected_size = request.get('size')
+            if track_name is None or segment_idx is None:
+                error_msg = 'Нужно указать все параметры'
+                self.log.error(error_msg)
+                return error_frame_parts(request_id, error_msg)
+            if not isinstance(offset, int) or offset < 0:
+                error_msg = 'offset должен быть неотрицательным целым'
+                self.log.error(error_msg)
+                return error_frame_parts(request_id, error_msg)
+            if self.prefetcher is not None and access is not None and isinstance(segment_idx, int):
+                self.prefetcher.observe(access, track_name, segment_idx, self.segment_count(track_name))
+
+            try:
+                parts = self.segment_parts(track_name, segment_idx, request_id, offset, expected_size)
+            except ServerBusy as busy:
+                return self.busy_parts(request_id, busy)
+            if parts is not None:
+                self.log_request('Аудио данные готовы к отправке')
+                return parts
+            else:
+                error_msg = 'Ошибка с аудио обработкой'
+                self.log.error(error_msg)
+                return error_frame_parts(request_id, error_msg)
+
+        elif cmd == 'get_range':
+            track_name = request.get('file_name')
+            start_ms = request.get('start_ms')
+            end_ms = request.get('end_ms')
+            if track_name not in self.track_info \
+                    or not isinstance(start_ms, (int, float)) or not isinstance(end_ms, (int, float)) \
+                    or start_ms < 0 or end_ms <= start_ms:
+                error_msg = 'Нужно указать существующий файл и диапазон 0 <= start_ms < end_ms'
+                self.log.error(error_msg)
+                return error_frame_parts(request_id, error_msg)
+
+            try:
+                audio = self.cut_range(track_name, start_ms, end_ms)
+            except ServerBusy as busy:
+                return self.busy_parts(request_id, busy)
+            if isinstance(audio, FileRegion):
+                return [pack_header(TYPE_AUDIO, request_id, audio.length), audio]
+            if audio:
+                return frame_parts(TYPE_AUDIO, request_id, audio)
+            error_msg = 'Диапазон вне трека или ошибка обработки'
+            self.log.error(error_msg)
+            return error_frame_parts(request_id, error_msg)
+
+        elif cmd == 'get_peaks':
+            try:
+                return json_frame_parts(request_id, self.peaks_response(request))
+            except ServerBusy as busy:
+                return self.busy_parts(request_id, busy)
+            except ValueError as e:
+                self.log.error(str(e))
+                return error_frame_parts(request_id, str(e))
+            except Exception as e:
+                self.log.error(f'Ошибка при построении пиков: {str(e)}', exc_info=True)
+                return error_frame_parts(request_id, 'Ошибка при построении пиков')
+
+        error_msg = f'Неизвестная команда: {cmd}'
+        self.log.error(error_msg)
+        return error_frame_parts(request_id, error_msg)
+
+    def catalog_parts(self, cmd, request, request_id):
+        # без параметров - весь каталог как раньше; с cursor/limit/prefix/contains/fields -
+        # страница, с since - изменения после версии клиента; compress - ответ в zlib;
+        # страница и изменения сообщают, какой шард кластера отдает этот узел
+        snapshot = self.snapshot
+        compress = bool(request.get('compress'))
+        if not any(key in request for key in self.CATALOG_QUERY):
+            return self.full_catalog_parts(snapshot, cmd, compress, request_id)
+        try:
+            query = self.parse_catalog_query(request)
+        except ValueError as e:
+            self.log.error(str(e))
+            return error_frame_parts(request_id, str(e))
+        if query['since'] is not None:
+            result = self.catalog_delta(snapshot, query['since'], query['fields'])
+        else:
+            result = self.catalog_page(snapshot, query, names_only=cmd == 'get_audio_list')
+        result['shard'] = self.shard_info()
+        if compress:
+            return zjson_frame_parts(request_id, result)
+        return json_frame_parts(request_id, result)
+
+    def full_catalog_parts(self, snapshot, cmd, compress, request_id):
+        # одинаковый для всех клиентов ответ кодируем один раз на снимок
+        key = (cmd, compress)
+        with self.catalog_payloads_lock:
+            if self.catalog_payloads_snapshot is not snapshot:
+                self.catalog_payloads = {}
+                self.catalog_payloads_snapshot = snapshot
+            payload = self.catalog_payloads.get(key)
+        if payload is None:
+            if cmd == 'get_metadata':
+                result = snapshot.track_info
+            else:
+                result = [info['name'] for info in snapshot.track_info.values()]
+            payload = json.dumps(result, ensure_ascii=False).encode('utf-8')
+            if compress:
+                payload = zlib.compress(payload)
+            with self.catalog_payloads_lock:
+                if self.catalog_payloads_snapshot is snapshot:
+                    self.catalog_payloads[key] = payload
+        return frame_parts(TYPE_ZJSON if compress else TYPE_JSON, request_id, payload)
+
+    def parse_catalog_query(self, request):
+        query = {
+            'limit': request.get('limit', self.MAX_PAGE_SIZE),
+            'since': request.get('since'),
+            'fields': request.get('fields')
+        }
+        if not isinstance(query['limit'], int) or not 0 < query['limit'] <= self.MAX_PAGE_SIZE:
+            raise ValueError(f'limit должен быть от 1 до {self.MAX_PAGE_SIZE}')
+        if query['since'] is not None and not isinstance(query['since'], int):
+            raise ValueError('since должен быть номером версии каталога')
+        if query['fields'] is not None and (
+                not isinstance(query['fields'], list) or not all(isinstance(f, str) for f in query['fields'])):
+            raise ValueError('fields должен быть списком имен полей')
+        for key in ('cursor', 'prefix', 'contains'):
+            query[key] = request.get(key)
+            if query[key] is not None and not isinstance(query[key], str):
+                raise ValueError(f'{key} должен быть строкой')
+        return query
+
+    @staticmethod
+    def select_fields(info, fields):
+        if fields is None:
+            return info
+        return {field: info[field] for field in fields if field in info}
+
+    def catalog_page(self, snapshot, query, names_only):
+        # names отсортированы: префикс - это отрезок, найденный бинарным поиском,
+        # cursor - имя, после которого продолжать
+        names = snapshot.names
+        prefix = query['prefix']
+        contains = query['contains']
+        start = bisect_left(names, prefix) if prefix else 0
+        if query['cursor'] is not None:
+            start = max(start, bisect_right(names, query['cursor']))
+        selected = []
+        next_cursor = None
+        for idx in range(start, len(names)):
+            name = names[idx]
+            if prefix and not name.startswith(prefix):
+                break
+            if contains and contains not in name:
+                continue
+            if len(selected) == query['limit']:
+                next_cursor = selected[-1]
+                break
+            selected.append(name)
+        if names_only:
+            tracks = selected
+        else:
+            tracks = {name: self.select_fields(snapshot.track_info[name], query['fields']) for name in selected}
+        return {'version': snapshot.version, 'tracks': tracks, 'next_cursor': next_cursor}
+
+    def catalog_delta(self, snapshot, since, fields):
+        # full=True - истории не хватает (сервер перезапускался или клиент сильно отстал),
+        # каталог нужно перечитать целиком
+        history = [item for item in self.catalog_changes if since < item[0] <= snapshot.version]
+        if since > snapshot.version or (since < snapshot.version and (
+                not history or history[0][0] != since + 1)):
+            return {'version': snapshot.version, 'full': True}
+        changed = set()
+        removed = set()
+        for _, changed_names, removed_names in history:
+            changed.difference_update(removed_names)
+            removed.update(removed_names)
+            removed.difference_update(changed_names)
+            changed.update(changed_names)
+        return {
+            'version': snapshot.version,
+            'full': False,
+            'changed': {
+                name: self.select_fields(snapshot.track_info[name], fields)
+                for name in sorted(changed) if name in snapshot.track_info
+            },
+            'removed': sorted(removed | {name for name in changed if name not in snapshot.track_info})
+        }
+
+    def segment_parts(self, track_name, segment_idx, request_id, offset=0, expected_size=None):
+        stored = self.find_stored_segment(track_name, segment_idx)
+        audio = None
+        if stored is not None:
+            total = stored.length
+        else:
+            audio = self.cut_audio(track_name, segment_idx)
+            if not audio:
+                return None
+            total = len(audio)
+
+        status = STATUS_OK
+        if offset and (offset > total or (expected_size is not None and expected_size != total)):
+            # у клиента кусок другой версии сегмента
+            offset = 0
+            status = STATUS_RESTART
+        if stored is not None:
+            region = FileRegion(stored.path, stored.offset + offset, stored.length - offset)
+            return [pack_header(TYPE_AUDIO, request_id, region.length, status), region]
+        return frame_parts(TYPE_AUDIO, request_id, memoryview(audio)[offset:], status)
+
+    def stream_command(self, cmd, request, request_id):
+        # get_segments: сегменты по одному кадру в порядке запроса, в конце TYPE_END;
+        # без списка segments отдается весь трек
+        track_name = request.get('file_name')
+        segments = request.get('segments')
+        if track_name not in self.track_info:
+            yield error_frame_parts(request_id, f'Нет такого файла: {track_name}')
+        elif segments is not None and (
+                not isinstance(segments, list) or not all(isinstance(idx, int) for idx in segments)):
+            yield error_frame_parts(request_id, 'segments должен быть списком индексов')
+        else:
+            if segments is None:
+                segments = range(self.segment_count(track_name))
+            self.log_request('Пакетная отправка %d сегментов %s', len(segments), track_name)
+            for position, segment_idx in enumerate(segments):
+                if self.prefetcher is not None:
+                    # список известен заранее, готовим следующие сегменты из него
+                    self.prefetcher.consume(track_name, segment_idx)
+                    self.prefetcher.schedule(
+                        track_name, segments[position + 1:position + 1 + self.prefetcher.depth]
+                    )
+                try:
+                    parts = self.segment_parts(track_name, segment_idx, request_id)
+                except ServerBusy as busy:
+                    # остаток потока клиент запросит позже
+                    yield self.busy_parts(request_id, busy)
+                    break
+                if parts is None:
+                    self.log.error(f'Ошибка с сегментом {segment_idx} {track_name}')
+                    parts = error_frame_parts(request_id, f'Ошибка с сегментом {segment_idx}')
+                yield parts
+        yield frame_parts(TYPE_END, request_id)
+
+    def send_parts(self, conn, parts):
+        self.metrics.inc('bytes_sent', self.parts_size(parts))
+        for part in parts:
+            if isinstance(part, FileRegion):
+                # данные идут из page cache в сокет, минуя python
+                with open(part.path, 'rb') as f:
+                    conn.sendfile(f, part.offset, part.length)
+            else:
+                conn.sendall(part)
+
+    def resolve_parts(self, parts):
+        # для asyncio: куски файлов заменяем буферами, sendfile там не используется
+        return [self.read_region(part) if isinstance(part, FileRegion) else part for part in parts]
+
+    def handle_command_buffers(self, cmd, request, request_id, access=None):
+        return self.resolve_parts(self.handle_command(cmd, request, request_id, access))
+
+    def next_frame_buffers(self, frames):
+        parts = next(frames, None)
+        return self.resolve_parts(parts) if parts is not None else None
+
     def process_client(self, conn):
+        self.metrics.inc('connections.total')
+        self.metrics.add_gauge('connections.active', 1)
+        # в соединение пишут и его поток, и рассылка событий подписки
+        send_lock = threading.Lock()
+        subscription = None
+        access = {}
+
+        def send_event(request_id, event):
+            # рассылка идет по подписчикам по очереди: клиент, который не читает,
+            # не должен держать остальных дольше io_timeout
+            if not send_lock.acquire(timeout=self.io_timeout):
+                drop_subscriber()
+            try:
+                self.send_parts(conn, json_frame_parts(request_id, event))
+            except socket.timeout:
+                drop_subscriber()
+            finally:
+                send_lock.release()
+
+        def drop_subscriber():
+            # кадр мог уйти не целиком, так что соединение только закрывать;
+            # shutdown будит поток соединения, он снимет подписку и закроет сокет
+            self.metrics.inc('timeouts')
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            raise ConnectionError('Подписчик не забирает события')
+
         try:
             client_addr = conn.getpeername()
             self.log.info(f'Обращается клиент {client_addr}')
             while True:
-                data = conn.recv(1024).decode('utf-8')
-                if not data:
+                if subscription is None:
+                    conn.settimeout(self.idle_timeout)
+                else:
+                    # подписчик может молчать сколько угодно, он ждет событий; ждем
+                    # через select, а таймаут сокета оставляем для отправки событий
+                    conn.settimeout(self.io_timeout)
+                    select.select([conn], [], [])
+                frame = recv_frame(conn, MAX_REQUEST_SIZE)
+                if frame is None:
                     break
-                self.log.debug(f'{client_addr} сделал запрос: {data}')
+                conn.settimeout(self.io_timeout)
+                frame_type, _, request_id, payload = frame
                 try:
-                    request = json.loads(data)
-                    cmd = request.get('command')
-                except json.JSONDecodeError:
-                    cmd = data
-
-                if cmd == 'get_metadata':
-                    self.log.debug('Отправка метаданных')
-                    response = json.dumps(self.track_info, ensure_ascii=False)
-                    conn.send(response.encode('utf-8'))
-
-                elif cmd == 'refresh':
-                    self.log.debug('Обновление метаданных')
-                    self.load_audio_files()
-                    response = json.dumps({'status': 'refreshed'})
-                    conn.send(response.encode('utf-8'))
-
-                elif cmd == 'get_audio_list':
-                    self.log.debug('Отправка списка аудио')
-                    response = json.dumps(
-                        [self.track_info[track]['name'] for track in self.track_info],
-                        ensure_ascii=False
-                    )
-                    conn.send(response.encode('utf-8'))
-
-                elif cmd == 'get_part_of_audio':
-                    track_name = request.get('file_name')
-                    segment_idx = request.get('segment_idx')
-                    if track_name is None or segment_idx is None:
-                        error_msg = 'Нужно указать все параметры'
-                        self.log.error(error_msg)
-                        response = json.dumps({'error': error_msg})
-                        conn.send(response.encode('utf-8'))
+                    cmd, request = self.parse_request(frame_type, payload)
+                except ProtocolError as e:
+                    self.log.error(f'{client_addr}: {e}')
+                    self.metrics.inc('errors.protocol')
+                    parts = error_frame_parts(request_id, str(e))
+                else:
+                    self.log_request('%s сделал запрос #%s: %s', client_addr, request_id, request)
+                    started = time.perf_counter()
+                    if cmd in self.STREAMING_COMMANDS:
+                        for parts in self.stream_command(cmd, request, request_id):
+                            with send_lock:
+                                self.send_parts(conn, parts)
+                        self.record_request(cmd, started, None)
                         continue
-
-                    audio = self.cut_audio(track_name, segment_idx)
-                    if audio:
-                        size = len(audio).to_bytes(8, byteorder='big')
-                        conn.send(size)
-                        conn.sendall(audio)
-                        self.log.info('Аудио данные успешно отправлены')
+                    if cmd in self.SUBSCRIPTION_COMMANDS:
+                        subscription, parts = self.handle_subscription(cmd, request_id, subscription, send_event)
                     else:
-                        error_msg = 'Ошибка с аудио обработкой'
-                        self.log.error(error_msg)
-                        response = json.dumps({'error': error_msg})
-                        conn.send(response.encode('utf-8'))
+                        parts = self.handle_command(cmd, request, request_id, access)
+                    self.record_request(cmd, started, parts)
+                with send_lock:
+                    self.send_parts(conn, parts)
+        except ConnectionError:
+            pass
+        except socket.timeout:
+            self.metrics.inc('timeouts')
+            self.log.info(f'Соединение {client_addr} закрыто по таймауту')
         except Exception as e:
             self.log.error(f'Ошибка {str(e)}', exc_info=True)
         finally:
+            if subscription is not None:
+                self.unsubscribe(subscription)
+            self.metrics.add_gauge('connections.active', -1)
             conn.close()
 
+    def run_async(self):
+        try:
+            asyncio.run(self.serve_async())
+        except asyncio.CancelledError:
+            pass
+
+    async def serve_async(self):
+        self.loop = asyncio.get_running_loop()
+        # экспорт сегментов и refresh блокируют, их выполняем вне event loop
+        self.executor = ThreadPoolExecutor(max_workers=self.export_workers)
+        self.async_server = await asyncio.start_server(
+            self.process_client_async,
+            self.host,
+            self.port,
+            backlog=self.backlog
+        )
+        self.is_running = True
+        print(f'Сервер (asyncio) стартанул, {self.host}:{self.port}')
+        try:
+            async with self.async_server:
+                await self.async_server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def process_client_async(self, reader, writer):
+        if self.connection_count >= self.max_connections:
+            self.metrics.inc('rejected.connections')
+            self.log.warning(f'Достигнут предел соединений {self.max_connections}')
+            writer.writelines(busy_frame_parts(0, self.RETRY_AFTER))
+            writer.close()
+            return
+        self.connection_count += 1
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_addr = writer.get_extra_info('peername')
+        self.log.info(f'Обращается клиент {client_addr}')
+        self.metrics.inc('connections.total')
+        self.metrics.add_gauge('connections.active', 1)
+        write_lock = asyncio.Lock()
+        in_flight = asyncio.Semaphore(self.PIPELINE_DEPTH)
+        tasks = set()
+        subscription = None
+        access = {}
+
+        def send_event(request_id, event):
+            # вызывается из потока загрузки, запись планируем в event loop
+            asyncio.run_coroutine_threadsafe(
+                self.write_parts_async(writer, write_lock, json_frame_parts(request_id, event)),
+                self.loop
+            )
+
+        try:
+            while True:
+                frame = await asyncio.wait_for(
+                    read_frame(reader, MAX_REQUEST_SIZE),
+                    self.idle_timeout if subscription is None else None
+                )
+                if frame is None:
+                    break
+                frame_type, _, request_id, payload = frame
+                try:
+                    cmd, request = self.parse_request(frame_type, payload)
+                except ProtocolError as e:
+                    self.log.error(f'{client_addr}: {e}')
+                    self.metrics.inc('errors.protocol')
+                    async with write_lock:
+                        writer.writelines(error_frame_parts(request_id, str(e)))
+                        await writer.drain()
+                    continue
+                self.log_request('%s сделал запрос #%s: %s', client_addr, request_id, request)
+                if cmd in self.SUBSCRIPTION_COMMANDS:
+                    started = time.perf_counter()
+                    subscription, parts = self.handle_subscription(cmd, request_id, subscription, send_event)
+                    self.record_request(cmd, started, parts)
+                    await self.write_parts_async(writer, write_lock, parts)
+                    continue
+                await in_flight.acquire()
+                # запросы выполняются параллельно, ответы уходят по мере готовности
+                task = asyncio.ensure_future(self.serve_request_async(
+                    writer, write_lock, in_flight, cmd, request, request_id, access
+                ))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.TimeoutError:
+            self.metrics.inc('timeouts')
+            self.log.info(f'Соединение {client_addr} закрыто по таймауту')
+        except Exception as e:
+            self.log.error(f'Ошибка {str(e)}', exc_info=True)
+        finally:
+            self.connection_count -= 1
+            if subscription is not None:
+                self.unsubscribe(subscription)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self.metrics.add_gauge('connections.active', -1)
+            writer.close()
+
+    async def write_parts_async(self, writer, write_lock, parts):
+        self.metrics.inc('bytes_sent', self.parts_size(parts))
+        async with write_lock:
+            writer.writelines(parts)
+            try:
+                await asyncio.wait_for(writer.drain(), self.io_timeout)
+            except asyncio.TimeoutError:
+                # клиент не читает, держать его буферы дальше незачем
+                self.metrics.inc('timeouts')
+                writer.transport.abort()
+                raise ConnectionError('Клиент не забирает данные')
+
+    async def serve_request_async(self, writer, write_lock, in_flight, cmd, request, request_id, access):
+        started = time.perf_counter()
+        queued = cmd in self.STREAMING_COMMANDS or cmd in self.BLOCKING_COMMANDS
+        try:
+            if queued:
+                # очередь пула не растет без предела: сверх нее сразу "занято"
+                if self.executor_pending >= self.export_workers + self.export_queue:
+                    self.metrics.inc('rejected.queue')
+                    queued = False
+                    parts = self.busy_parts(request_id, ServerBusy(self.RETRY_AFTER))
+                    self.record_request(cmd, started, parts)
+                    await self.write_parts_async(writer, write_lock, parts)
+                    return
+                self.executor_pending += 1
+            if cmd in self.STREAMING_COMMANDS:
+                frames = self.stream_command(cmd, request, request_id)
+                while True:
+                    parts = await self.loop.run_in_executor(
+                        self.executor, self.next_frame_buffers, frames
+                    )
+                    if parts is None:
+                        break
+                    await self.write_parts_async(writer, write_lock, parts)
+                self.record_request(cmd, started, None)
+                return
+            if cmd in self.BLOCKING_COMMANDS:
+                parts = await self.loop.run_in_executor(
+                    self.executor, self.handle_command_buffers, cmd, request, request_id, access
+                )
+            else:
+                parts = self.handle_command(cmd, request, request_id, access)
+            self.record_request(cmd, started, parts)
+            await self.write_parts_async(writer, write_lock, parts)
+        except ConnectionError:
+            pass
+        finally:
+            if queued:
+                self.executor_pending -= 1
+            in_flight.release()
+
     def stop(self):
         self.is_running = False
+        self.watch_stop.set()
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
+        self.metrics_stop.set()
+        if self.metrics_file:
+            self.metrics.dump(self.metrics_file, self.metrics_extra())
         if self.socket:
             self.socket.close()
+        if self.async_server and self.loop:
+            self.loop.call_soon_threadsafe(self.async_server.close)
 
 
 if __name__ == '__main__':
-    server = Server()
+    parser = argparse.ArgumentParser(description='Сервер для выдачи аудио файлов по частям')
+    parser.add_argument('--host', default='localhost', help='Адрес сервера')
+    parser.add_argument('--port', type=int, default=8899, help='Порт сервера')
+    parser.add_argument('--audio', default='audio', help='Папка с аудио файлами')
+    parser.add_argument('--lazy', action='store_true',
+                        help='Не декодировать файлы при старте, только по запросу сегмента')
+    parser.add_argument('--cache-mb', type=int, default=64,
+                        help='Размер кэша готовых сегментов в МБ (0 - отключить)')
+    parser.add_argument('--mode', choices=['threads', 'async'], default='threads',
+                        help='threads - поток на клиента, async - один поток с asyncio')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Число потоков для экспорта сегментов в режиме async')
+    parser.add_argument('--prerender', action='store_true',
+                        help='Фоново сохранять готовые сегменты на диск и отдавать их через sendfile')
+    parser.add_argument('--ingest-workers', type=int, default=None,
+                        help='Число процессов для загрузки библиотеки (1 - без пула)')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='DEBUG',
+                        help='Уровень логирования')
+    parser.add_argument('--log-every', type=int, default=1,
+                        help='Писать в лог каждый n-й запрос (0 - не писать запросы)')
+    parser.add_argument('--metrics-file', default=None,
+                        help='Файл, куда периодически пишутся метрики в текстовом виде')
+    parser.add_argument('--metrics-interval', type=float, default=10,
+                        help='Период записи метрик в секундах')
+    parser.add_argument('--max-connections', type=int, default=256,
+                        help='Предел одновременных соединений, сверх него клиент получает "занято"')
+    parser.add_argument('--export-queue', type=int, default=None,
+                        help='Сколько экспортов может ждать свободного потока (по умолчанию 4 на поток)')
+    parser.add_argument('--idle-timeout', type=float, default=300,
+                        help='Сколько секунд ждать следующего запроса клиента')
+    parser.add_argument('--io-timeout', type=float, default=30,
+                        help='Таймаут чтения и записи кадра в секундах')
+    parser.add_argument('--backlog', type=int, default=128,
+                        help='Длина очереди входящих соединений')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Сколько следующих сегментов готовить заранее при последовательном чтении (0 - выкл)')
+    parser.add_argument('--prefetch-mb', type=int, default=16,
+                        help='Сколько МБ могут занимать подготовленные, но еще не запрошенные сегменты')
+    parser.add_argument('--peaks', action='store_true',
+                        help='Считать пирамиды пиков для формы волны при загрузке, а не по запросу')
+    parser.add_argument('--watch', action='store_true',
+                        help='Следить за папкой с аудио и подхватывать изменения без refresh')
+    parser.add_argument('--watch-interval', type=float, default=2.0,
+                        help='Период опроса папки в секундах')
+    parser.add_argument('--shard-nodes', default=None,
+                        help='Все узлы кластера через запятую (host:port,host:port); '
+                             'узел загружает только свои треки')
+    parser.add_argument('--shard-node', default=None,
+                        help='Имя этого узла в списке, по умолчанию host:port')
+    parser.add_argument('--replicas', type=int, default=2,
+                        help='На скольких узлах хранится каждый трек')
+    parser.add_argument('--catalog', default=None,
+                        help='Файл каталога; при нескольких узлах в одной папке у каждого свой')
+    args = parser.parse_args()
+
+    shard_nodes = args.shard_nodes.split(',') if args.shard_nodes else None
+    catalog_file = args.catalog
+    if catalog_file is None:
+        catalog_file = f'audio_metadata_{args.port}.json' if shard_nodes else 'audio_metadata.json'
+
+    server = Server(host=args.host, port=args.port, audio_folder=args.audio, lazy=args.lazy,
+                    cache_size=args.cache_mb * 1024 * 1024, export_workers=args.workers,
+                    prerender=args.prerender, ingest_workers=args.ingest_workers,
+                    log_level=getattr(logging, args.log_level), log_every=args.log_every,
+                    metrics_file=args.metrics_file, metrics_interval=args.metrics_interval,
+                    watch=args.watch, watch_interval=args.watch_interval,
+                    max_connections=args.max_connections, export_queue=args.export_queue,
+                    idle_timeout=args.idle_timeout, io_timeout=args.io_timeout, backlog=args.backlog,
+                    peaks=args.peaks, prefetch_depth=args.prefetch,
+                    prefetch_budget=args.prefetch_mb * 1024 * 1024, catalog_file=catalog_file,
+                    shard_nodes=shard_nodes, shard_node=args.shard_node, replicas=args.replicas)
     try:
-        server.run()
+        if args.mode == 'async':
+            server.run_async()
+        else:
+            server.run()
     except KeyboardInterrupt:
         print('\nЗавершение работы')
         server.stop()
@@ -0,0 +1,54 @@
+import hashlib
+from bisect import bisect_right
+
+# распределение треков по серверам без координатора: у всех серверов и клиентов
+# один и тот же список узлов, поэтому каждый сам считает, кто за какой трек отвечает
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+def parse_node(node):
+    host, _, port = node.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f'Узел должен быть в виде host:port: {node}')
+    return host, int(port)
+
+
+class HashRing:
+    # консистентное хэширование: у каждого узла vnodes точек на кольце, трек принадлежит
+    # первым replicas разным узлам по часовой стрелке от своего хэша; при добавлении
+    # узла к нему переезжает около 1/N треков, остальные остаются на месте
+    def __init__(self, nodes, replicas=2, vnodes=100):
+        nodes = list(dict.fromkeys(nodes))
+        if not nodes:
+            raise ValueError('Нужен хотя бы один узел')
+        self.nodes = nodes
+        self.replicas = max(1, min(replicas, len(nodes)))
+        self.vnodes = vnodes
+        points = sorted(
+            (ring_hash(f'{node}#{idx}'), node)
+            for node in nodes
+            for idx in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owners(self, key):
+        # узлы в порядке предпочтения: первый - основной, остальные - реплики
+        result = []
+        start = bisect_right(self._hashes, ring_hash(key))
+        for offset in range(len(self._nodes)):
+            node = self._nodes[(start + offset) % len(self._nodes)]
+            if node not in result:
+                result.append(node)
+                if len(result) == self.replicas:
+                    break
+        return result
+
+    def owns(self, node, key):
+        return node in self.owners(key)
+
+    def describe(self, node):
+        return {'node': node, 'nodes': self.nodes, 'replicas': self.replicas, 'vnodes': self.vnodes}
@@ -11,8 +11,8 @@ from app.schemas.user import UserCreate, UserWithToken, User
 from app.cruds.user import create_user, get_user_by_email
 from app.db.session import get_db
 
-from app.services.huffman import HuffmanCoding
-from app.services.xor import XORCipher
+from app.services.codec import TextCodec
+from app.api.endpoints.encode import run_codec
 from app.schemas.encode import EncodeRequest, EncodeResponse, DecodeRequest, DecodeResponse
 from typing import Dict
 
@@ -72,33 +72,29 @@ async def get_me(current_user: User = Depends(get_current_user)):
 
 @router.post("/encode", response_model=EncodeResponse)
 async def encode_text(request: EncodeRequest):
-    # Сжатие методом хаффмана
-    frequency = HuffmanCoding.build_frequency_dict(request.text)
-    tree = HuffmanCoding.build_huffman_tree(frequency)
-    huffman_codes = HuffmanCoding.build_codes(tree)
-    encoded_text, padding = HuffmanCoding.encode_text(request.text, huffman_codes)
-
-    # шифрование с использованием xor
-    encrypted_data = XORCipher.encrypt(encoded_text, request.key)
-
-    return EncodeResponse(
-        encoded_data=encrypted_data,
-        key=request.key,
-        huffman_codes=huffman_codes,
-        padding=padding
+    # Сжатие методом хаффмана и шифрование с использованием xor
+    result = await run_codec(
+        TextCodec.encode,
+        request.text,
+        request.key,
+        request.mode,
+        codes_format=request.codes_format
     )
 
+    return EncodeResponse(**result)
+
 
 @router.post("/decode", response_model=DecodeResponse)
 async def decode_text(request: DecodeRequest):
-    # xor расшифровка
-    decrypted_data = XORCipher.decrypt(request.encoded_data, request.key)
-
-    # распаковка текста методом хаффмана
-    decoded_text = HuffmanCoding.decode_text(
-        decrypted_data,
+    # xor расшифровка и распаковка текста методом хаффмана
+    decoded_text = await run_codec(
+        TextCodec.decode,
+        request.encoded_data,
+        request.key,
         request.huffman_codes,
-        request.padding
+        request.padding,
+        request.mode,
+        huffman_header=request.huffman_header
     )
 
     return DecodeResponse(decoded_text=decoded_text)
@@ -1,40 +1,194 @@
-from fastapi import APIRouter, Depends
-from app.services.huffman import HuffmanCoding
-from app.services.xor import XORCipher
+import codecs
+from concurrent.futures import BrokenExecutor
+from typing import AsyncIterator
+
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from app.core.config import settings
+from app.services.codec import (
+    TextCodec, StreamEncoder, StreamDecoder, SpooledUpload, stream_step, stream_finish
+)
+from app.services.executor import codec_executor, ExecutorBusy, ExecutorTimeout, ExecutorSlot
 from app.schemas.encode import EncodeRequest, EncodeResponse, DecodeRequest, DecodeResponse
 
 router = APIRouter()
 
+# через сколько секунд повторить запрос, если пул занят или только что упал воркер
+RETRY_AFTER = "1"
+
+
+def codec_unavailable(detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=detail,
+        headers={"Retry-After": RETRY_AFTER}
+    )
+
+
+async def run_codec(fn, *args, **kwargs):
+    # тяжелая работа кодека идет в пуле, а не в цикле событий, и не мешает остальным
+    # запросам; ошибка в данных - 400, пул перегружен или упал воркер - 503, не успели - 504
+    try:
+        return await codec_executor.run(fn, *args, **kwargs)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except ExecutorBusy as e:
+        raise codec_unavailable(str(e))
+    except ExecutorTimeout as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(e))
+    except BrokenExecutor:
+        # пул уже выброшен, следующий запрос получит новый
+        raise codec_unavailable("Воркер сжатия упал, повторите запрос")
+
+
+def reserve_codec() -> ExecutorSlot:
+    try:
+        return codec_executor.reserve()
+    except ExecutorBusy as e:
+        raise codec_unavailable(str(e))
+
 
 @router.post("/encode", response_model=EncodeResponse)
 async def encode_text(request: EncodeRequest):
-    # сжатие хаффмана
-    frequency = HuffmanCoding.build_frequency_dict(request.text)
-    tree = HuffmanCoding.build_huffman_tree(frequency)
-    codes = HuffmanCoding.build_codes(tree)
-    encoded_text, padding = HuffmanCoding.encode_text(request.text, codes)
-
-    # xor шифрование
-    encrypted_data = XORCipher.encrypt(encoded_text, request.key)
-
-    return EncodeResponse(
-        encoded_data=encrypted_data,
-        key=request.key,
-        huffman_codes=codes,
-        padding=padding
+    # сжатие хаффмана и xor шифрование
+    result = await run_codec(
+        TextCodec.encode,
+        request.text,
+        request.key,
+        request.mode,
+        codes_format=request.codes_format
     )
 
+    return EncodeResponse(**result)
+
 
 @router.post("/decode", response_model=DecodeResponse)
 async def decode_text(request: DecodeRequest):
-    # xor расшифровка
-    decrypted_data = XORCipher.decrypt(request.encoded_data, request.key)
-
-    # распаковка хаффмана
-    decoded_text = HuffmanCoding.decode_text(
-        decrypted_data,
+    # xor расшифровка и распаковка хаффмана
+    decoded_text = await run_codec(
+        TextCodec.decode,
+        request.encoded_data,
+        request.key,
         request.huffman_codes,
-        request.padding
+        request.padding,
+        request.mode,
+        huffman_header=request.huffman_header
+    )
+
+    return DecodeResponse(decoded_text=decoded_text)
+
+
+async def spool_upload(request: Request, upload: SpooledUpload) -> None:
+    # тело запроса читается целиком до начала ответа: пока идет StreamingResponse,
+    # starlette сам слушает receive, и куски тела читать уже нельзя
+    async for chunk in request.stream():
+        if upload.size + len(chunk) > settings.MAX_STREAM_SIZE:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Документ больше {settings.MAX_STREAM_SIZE} байт"
+            )
+        await run_in_threadpool(upload.write, chunk)
+    await run_in_threadpool(upload.finish)
+
+
+async def iter_encoded(upload: SpooledUpload, encoder: StreamEncoder, header: bytes,
+                       slot: ExecutorSlot) -> AsyncIterator[bytes]:
+    # второй проход: сохраненная загрузка кусками через кодировщик в пуле; ошибка
+    # в середине потока видна клиенту только как оборванный ответ
+    try:
+        yield header
+        utf8 = codecs.getincrementaldecoder('utf-8')()
+        while True:
+            chunk = await run_in_threadpool(upload.read, settings.STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            encoder, encoded = await codec_executor.run(stream_step, encoder, utf8.decode(chunk), reserved=True)
+            if encoded:
+                yield encoded
+        encoder, encoded = await codec_executor.run(stream_step, encoder, utf8.decode(b'', final=True), reserved=True)
+        encoder, last = await codec_executor.run(stream_finish, encoder, reserved=True)
+        yield encoded + last
+    finally:
+        upload.close()
+        slot.release()
+
+
+async def iter_decoded(upload: SpooledUpload, decoder: StreamDecoder, decoded: str,
+                       slot: ExecutorSlot) -> AsyncIterator[bytes]:
+    try:
+        yield decoded.encode('utf-8')
+        while True:
+            chunk = await run_in_threadpool(upload.read, settings.STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            decoder, text = await codec_executor.run(stream_step, decoder, chunk, reserved=True)
+            if text:
+                yield text.encode('utf-8')
+        decoder, text = await codec_executor.run(stream_finish, decoder, reserved=True)
+        yield text.encode('utf-8')
+    finally:
+        upload.close()
+        slot.release()
+
+
+@router.post("/stream/encode")
+async def stream_encode(request: Request, key: str = Query(..., description="Ключ xor")):
+    # тело - текст в utf-8 любого размера; первый проход сохраняет его (в памяти только
+    # первые STREAM_SPOOL_SIZE байт) и считает частоты, второй сжимает и шифрует прямо в ответ;
+    # весь поток занимает одно место в пуле кодека, куски сжимаются там же
+    upload = SpooledUpload(settings.STREAM_SPOOL_SIZE, count=True)
+    slot = None
+    try:
+        await spool_upload(request, upload)
+        slot = reserve_codec()
+        codes = await run_codec(TextCodec.codes_from_frequency, upload.frequency, reserved=True)
+        encoder = StreamEncoder(key, codes)
+        header = await run_codec(StreamEncoder.start, encoder, reserved=True)
+    except BaseException as e:
+        upload.close()
+        if slot is not None:
+            slot.release()
+        if isinstance(e, ValueError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        raise
+
+    # background освобождает место, даже если ответ оборвался до первого куска
+    return StreamingResponse(
+        iter_encoded(upload, encoder, header, slot),
+        media_type="application/octet-stream",
+        background=BackgroundTask(slot.release)
     )
 
-    return DecodeResponse(decoded_text=decoded_text)
\ No newline at end of file
+
+@router.post("/stream/decode")
+async def stream_decode(request: Request, key: str = Query(..., description="Ключ xor")):
+    # заголовок потока разбираем до ответа, чтобы на чужие данные ответить 400;
+    # текст отдается по мере распаковки и целиком в памяти не лежит
+    upload = SpooledUpload(settings.STREAM_SPOOL_SIZE)
+    slot = None
+    try:
+        await spool_upload(request, upload)
+        slot = reserve_codec()
+        decoder = StreamDecoder(key)
+        decoded = []
+        while not decoder.started:
+            chunk = await run_in_threadpool(upload.read, settings.STREAM_CHUNK_SIZE)
+            if not chunk:
+                raise ValueError('Поток обрывается')
+            decoder, text = await run_codec(stream_step, decoder, chunk, reserved=True)
+            decoded.append(text)
+    except BaseException as e:
+        upload.close()
+        if slot is not None:
+            slot.release()
+        if isinstance(e, ValueError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        raise
+
+    return StreamingResponse(
+        iter_decoded(upload, decoder, ''.join(decoded), slot),
+        media_type="text/plain; charset=utf-8",
+        background=BackgroundTask(slot.release)
+    )
\ No newline at end of file
@@ -0,0 +1,126 @@
+import asyncio
+from typing import Any, Optional, Tuple
+
+from celery.result import AsyncResult
+from fastapi import APIRouter, HTTPException, Query, Response, status
+from fastapi.concurrency import run_in_threadpool
+
+from app.core.celery_config import celery_app
+from app.core.config import settings
+from app.api.endpoints.encode import run_codec
+from app.schemas.encode import EncodeRequest, DecodeRequest
+from app.schemas.job import JobStatus, JobResult
+from app.services.codec import TextCodec
+from app.tasks.encode_tasks import encode_task, decode_task
+
+router = APIRouter()
+
+# состояния, после которых задача уже не изменится
+FINISHED_STATES = ("SUCCESS", "FAILURE", "REVOKED")
+
+
+def read_job(job_id: str) -> Tuple[JobStatus, Any]:
+    # статус задачи и то, что она вернула; задачи ловят свои ошибки сами
+    # и возвращают {'status': 'FAILURE', 'error': ...}, для клиента это тоже FAILURE
+    # неизвестный id celery не отличает от ждущей задачи, такой job_id вечно PENDING
+    result = AsyncResult(job_id, app=celery_app)
+    state = result.state
+    info = result.info
+    job = JobStatus(job_id=job_id, status=state)
+    if state == "PROGRESS" and isinstance(info, dict):
+        job.stage = info.get("status")
+        job.stage_index = info.get("stage")
+        job.stages = info.get("stages")
+    elif state == "SUCCESS" and isinstance(info, dict) and info.get("status") == "FAILURE":
+        job.status = "FAILURE"
+        job.error = info.get("error")
+    elif state == "FAILURE":
+        job.error = str(info)
+    return job, info
+
+
+def inline_status(result: dict) -> JobStatus:
+    return JobStatus(status="SUCCESS", result=result)
+
+
+@router.post("/encode", response_model=JobStatus, status_code=status.HTTP_202_ACCEPTED)
+async def submit_encode(request: EncodeRequest, response: Response):
+    # короткий текст сжимается сразу в пуле веб-сервера, длинный уходит воркеру celery
+    if len(request.text) <= settings.JOB_INLINE_MAX_LENGTH:
+        result = await run_codec(
+            TextCodec.encode,
+            request.text,
+            request.key,
+            request.mode,
+            codes_format=request.codes_format
+        )
+        response.status_code = status.HTTP_200_OK
+        return inline_status(result)
+
+    task = await run_in_threadpool(
+        encode_task.delay,
+        request.text,
+        request.key,
+        request.mode,
+        request.codes_format
+    )
+    return JobStatus(job_id=task.id, status="PENDING")
+
+
+@router.post("/decode", response_model=JobStatus, status_code=status.HTTP_202_ACCEPTED)
+async def submit_decode(request: DecodeRequest, response: Response):
+    if len(request.encoded_data) <= settings.JOB_INLINE_MAX_LENGTH:
+        decoded_text = await run_codec(
+            TextCodec.decode,
+            request.encoded_data,
+            request.key,
+            request.huffman_codes,
+            request.padding,
+            request.mode,
+            huffman_header=request.huffman_header
+        )
+        response.status_code = status.HTTP_200_OK
+        return inline_status({"decoded_text": decoded_text})
+
+    task = await run_in_threadpool(
+        decode_task.delay,
+        request.encoded_data,
+        request.key,
+        request.huffman_codes,
+        request.padding,
+        request.mode,
+        request.huffman_header
+    )
+    return JobStatus(job_id=task.id, status="PENDING")
+
+
+@router.get("/{job_id}", response_model=JobStatus)
+async def get_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=settings.JOB_MAX_WAIT, description="Сколько секунд ждать изменений"),
+    stage: Optional[str] = Query(None, description="Последний известный клиенту этап или статус")
+):
+    # долгий опрос: при wait > 0 ответ приходит, когда этап задачи отличается от stage
+    # (по умолчанию - от этапа на момент запроса), задача завершилась или вышло время
+    job, _ = await run_in_threadpool(read_job, job_id)
+    seen = stage if stage is not None else (job.stage or job.status)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    while job.status not in FINISHED_STATES and (job.stage or job.status) == seen \
+            and loop.time() < deadline:
+        await asyncio.sleep(min(settings.JOB_POLL_INTERVAL, max(deadline - loop.time(), 0)))
+        job, _ = await run_in_threadpool(read_job, job_id)
+    return job
+
+
+@router.get("/{job_id}/result", response_model=JobResult)
+async def get_job_result(job_id: str):
+    job, info = await run_in_threadpool(read_job, job_id)
+    if job.status == "FAILURE":
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=job.error)
+    if job.status != "SUCCESS":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Задача еще не выполнена: {job.status}"
+        )
+    return JobResult(job_id=job_id, result=info["result"])
\ No newline at end of file
@@ -14,4 +14,8 @@ celery_app.conf.update(
     result_serializer="json",
     timezone="UTC",
     enable_utc=True,
+    # STARTED виден в статусе задачи, пока воркер не сообщил первый этап
+    task_track_started=True,
+    # результаты, которые так и не забрали, живут час
+    result_expires=3600,
 )
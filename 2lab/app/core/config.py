@@ -23,6 +23,22 @@ class Settings(BaseSettings):
     # доп настройки шифрования
     MAX_ENCRYPTION_TEXT_LENGTH: int = 10_000  # max длина текста
 
+    # потоковые эндпоинты
+    STREAM_CHUNK_SIZE: int = 64 * 1024  # сколько байт обрабатывать за раз
+    STREAM_SPOOL_SIZE: int = 8 * 1024 * 1024  # больше этого загрузка лежит на диске, а не в памяти
+    MAX_STREAM_SIZE: int = 1024 * 1024 * 1024  # max размер загружаемого документа
+
+    # задачи сжатия через celery
+    JOB_INLINE_MAX_LENGTH: int = 10_000  # текст не длиннее этого сжимается сразу, без очереди
+    JOB_MAX_WAIT: float = 30.0  # max время долгого опроса статуса, секунды
+    JOB_POLL_INTERVAL: float = 0.2  # как часто при долгом опросе проверять задачу
+
+    # сжатие в процессе веб-сервера, вне цикла событий
+    CODEC_EXECUTOR: str = "process"  # process или thread
+    CODEC_WORKERS: int = 0  # 0 - по числу ядер
+    CODEC_QUEUE_SIZE: int = 16  # сколько запросов может ждать свободного воркера, остальным 503
+    CODEC_TIMEOUT: float = 30.0  # дольше этого запрос не ждет, отвечаем 504
+
     class Config:
         env_file = ".env"
         case_sensitive = True
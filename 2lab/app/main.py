@@ -4,19 +4,25 @@
 
 
 from fastapi import FastAPI
-from app.api.endpoints import auth, encode
+from app.api.endpoints import auth, encode, jobs
 from app.core.config import settings
 from app.db.session import create_tables
+from app.services.executor import codec_executor
 
 app = FastAPI(title=settings.PROJECT_NAME)
 
 app.include_router(auth.router, prefix="/auth", tags=["auth"])
 app.include_router(encode.router, prefix="/encode", tags=["encode"])
+app.include_router(jobs.router, prefix="/jobs", tags=["jobs"])
 
 @app.on_event("startup")
 def on_startup():
     create_tables()
 
+@app.on_event("shutdown")
+def on_shutdown():
+    codec_executor.shutdown()
+
 @app.get("/", summary="Корневой маршрут", tags=["Основные"])
 def read_root():
     return {
@@ -24,3 +30,11 @@ def read_root():
         "docs": "/docs",
         "redoc": "/redoc"
     }
+
+
+@app.get("/health", summary="Состояние сервиса", tags=["Основные"])
+def health():
+    return {
+        "status": "ok",
+        "codec": codec_executor.stats()
+    }
\ No newline at end of file
@@ -12,6 +12,10 @@ from .encode import (
     DecodeRequest,
     DecodeResponse,
 )
+from .job import (
+    JobStatus,
+    JobResult,
+)
 
 __all__ = [
     "UserBase",
@@ -24,4 +28,6 @@ __all__ = [
     "EncodeResponse",
     "DecodeRequest",
     "DecodeResponse",
+    "JobStatus",
+    "JobResult",
 ]
\ No newline at end of file
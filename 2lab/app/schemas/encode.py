@@ -1,20 +1,43 @@
-from pydantic import BaseModel
+from typing import Dict, Literal, Optional
+
+from pydantic import BaseModel, model_validator
+
+# packed - упакованные биты в base64, bits - прежний формат из строки '0'/'1'
+CodecMode = Literal["packed", "bits"]
+# header - длины канонических кодов компактной base64 строкой, json - прежний словарь кодов
+CodesFormat = Literal["header", "json"]
 
 class EncodeRequest(BaseModel):
     text: str
     key: str
+    mode: CodecMode = "packed"
+    codes_format: CodesFormat = "header"
 
 class EncodeResponse(BaseModel):
     encoded_data: str
     key: str
-    huffman_codes: dict
+    huffman_codes: Optional[Dict[str, str]] = None
+    huffman_header: Optional[str] = None
     padding: int
+    mode: CodecMode = "packed"
 
 class DecodeRequest(BaseModel):
     encoded_data: str
     key: str
-    huffman_codes: dict
+    huffman_codes: Optional[Dict[str, str]] = None
+    huffman_header: Optional[str] = None
     padding: int
+    # без mode режим следует из формата кодов: прежние клиенты присылают
+    # huffman_codes вместе со строкой из '0'/'1' и про mode не знают
+    mode: Optional[CodecMode] = None
+
+    @model_validator(mode="after")
+    def check_codes(self):
+        if (self.huffman_codes is None) == (self.huffman_header is None):
+            raise ValueError("Нужно передать ровно одно из huffman_codes и huffman_header")
+        if self.mode is None:
+            self.mode = "bits" if self.huffman_codes is not None else "packed"
+        return self
 
 class DecodeResponse(BaseModel):
     decoded_text: str
\ No newline at end of file
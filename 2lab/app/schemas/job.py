@@ -0,0 +1,20 @@
+from pydantic import BaseModel
+from typing import Optional
+
+
+class JobStatus(BaseModel):
+    # job_id нет, если запрос был маленьким и выполнен сразу, тогда result уже заполнен
+    job_id: Optional[str] = None
+    # PENDING, STARTED, PROGRESS, SUCCESS, FAILURE, REVOKED
+    status: str
+    # название текущего этапа и его номер из stages
+    stage: Optional[str] = None
+    stage_index: Optional[int] = None
+    stages: Optional[int] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+
+
+class JobResult(BaseModel):
+    job_id: str
+    result: dict
\ No newline at end of file
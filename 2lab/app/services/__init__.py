@@ -1,5 +1,7 @@
 from .huffman import HuffmanCoding
 from .xor import XORCipher
+from .codec import TextCodec
+from .executor import CodecExecutor, codec_executor
 from .celery_worker import celery_app
 
-__all__ = ["HuffmanCoding", "XORCipher", "celery_app"]
\ No newline at end of file
+__all__ = ["HuffmanCoding", "XORCipher", "TextCodec", "CodecExecutor", "codec_executor", "celery_app"]
\ No newline at end of file
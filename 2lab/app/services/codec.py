@@ -0,0 +1,249 @@
+import base64
+import binascii
+import codecs
+import struct
+import tempfile
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+from app.services.huffman import HuffmanCoding, HuffmanDecoder, MAX_SYMBOLS
+from app.services.xor import XORCipher
+
+# packed - биты упакованы в байты, xor по байтам, base64 один раз на выходе;
+# bits - прежний формат: строка из '0'/'1', xor по символам
+MODES = ("packed", "bits")
+# как передавать коды: header - длины канонических кодов, json - словарь символ -> код
+CODES_FORMATS = ("header", "json")
+
+Progress = Optional[Callable[[str], None]]
+
+
+class TextCodec:
+    # этапы, о которых сообщает progress, по порядку
+    ENCODE_STAGES = ('Huffman encoding...', 'XOR encryption...')
+    DECODE_STAGES = ('XOR decryption...', 'Huffman decoding...')
+
+    @staticmethod
+    def _report(progress: Progress, status: str) -> None:
+        if progress is not None:
+            progress(status)
+
+    @staticmethod
+    def build_codes(text: str) -> Dict[str, str]:
+        if not text:
+            return {}
+        return TextCodec.codes_from_frequency(HuffmanCoding.build_frequency_dict(text))
+
+    @staticmethod
+    def codes_from_frequency(frequency: Dict[str, int]) -> Dict[str, str]:
+        if not frequency:
+            return {}
+        if len(frequency) > MAX_SYMBOLS:
+            raise ValueError(f'В тексте больше {MAX_SYMBOLS} разных символов')
+        return HuffmanCoding.canonical_codes(HuffmanCoding.code_lengths(frequency))
+
+    @staticmethod
+    def resolve_codes(huffman_codes: Optional[Dict[str, str]], huffman_header: Optional[str]) -> Dict[str, str]:
+        if huffman_header is not None:
+            return HuffmanCoding.parse_header(huffman_header)
+        if huffman_codes is None:
+            raise ValueError("Нет ни huffman_codes, ни huffman_header")
+        return huffman_codes
+
+    @staticmethod
+    def encode(text: str, key: str, mode: str = "packed", progress: Progress = None,
+               codes_format: str = "header") -> dict:
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный режим: {mode}")
+        if codes_format not in CODES_FORMATS:
+            raise ValueError(f"Неизвестный формат кодов: {codes_format}")
+
+        # сжатие хаффмана
+        TextCodec._report(progress, TextCodec.ENCODE_STAGES[0])
+        codes = TextCodec.build_codes(text)
+        if mode == "packed":
+            packed, padding = HuffmanCoding.encode_bytes(text, codes)
+        else:
+            encoded_text, padding = HuffmanCoding.encode_text(text, codes)
+
+        # xor шифрование
+        TextCodec._report(progress, TextCodec.ENCODE_STAGES[1])
+        if mode == "packed":
+            encrypted_data = base64.b64encode(XORCipher.xor_bytes(packed, key)).decode('ascii')
+        else:
+            encrypted_data = XORCipher.encrypt(encoded_text, key)
+
+        result = {
+            "encoded_data": encrypted_data,
+            "key": key,
+            "padding": padding,
+            "mode": mode
+        }
+        if codes_format == "header":
+            result["huffman_header"] = HuffmanCoding.serialize_header(codes)
+        else:
+            result["huffman_codes"] = codes
+        return result
+
+    @staticmethod
+    def decode(encoded_data: str, key: str, huffman_codes: Optional[Dict[str, str]], padding: int,
+               mode: str = "packed", progress: Progress = None, huffman_header: Optional[str] = None) -> str:
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный режим: {mode}")
+        codes = TextCodec.resolve_codes(huffman_codes, huffman_header)
+
+        # xor расшифровка
+        TextCodec._report(progress, TextCodec.DECODE_STAGES[0])
+        if mode == "packed":
+            if not 0 <= padding < 8:
+                raise ValueError("padding должен быть от 0 до 7")
+            try:
+                packed = base64.b64decode(encoded_data, validate=True)
+            except binascii.Error as e:
+                raise ValueError(f"encoded_data не в base64: {e}")
+            decrypted_data = XORCipher.xor_bytes(packed, key)
+        else:
+            decrypted_data = XORCipher.decrypt(encoded_data, key)
+
+        # распаковка хаффмана
+        TextCodec._report(progress, TextCodec.DECODE_STAGES[1])
+        if mode == "packed":
+            return HuffmanCoding.decode_bytes(decrypted_data, codes, padding)
+        return HuffmanCoding.decode_text(decrypted_data, codes, padding)
+
+
+# потоковый формат: метка, длина заголовка (4 байта), заголовок с длинами кодов,
+# упакованные биты после xor и в конце один байт - сколько нулевых бит дописано в последний байт
+STREAM_MAGIC = b'HXS1'
+STREAM_HEADER = struct.Struct('!4sI')
+# заголовок длиннее этого - точно не наш: даже у всех символов unicode он меньше 8 МБ
+MAX_STREAM_HEADER = 8 * 1024 * 1024
+
+
+class StreamEncoder:
+    # коды нужны заранее, поэтому частоты считаются отдельным проходом по тексту
+    def __init__(self, key: str, codes: Dict[str, str]):
+        self.codes = codes
+        self.xor = XORCipher.stream(key)
+        self.tail = ''
+
+    def start(self) -> bytes:
+        header = HuffmanCoding.header_bytes(self.codes)
+        return STREAM_HEADER.pack(STREAM_MAGIC, len(header)) + header
+
+    def feed(self, text: str) -> bytes:
+        packed, self.tail = HuffmanCoding.encode_chunk(text, self.codes, self.tail)
+        return self.xor.process(packed)
+
+    def finish(self) -> bytes:
+        last, padding = HuffmanCoding.finish_chunks(self.tail)
+        self.tail = ''
+        return self.xor.process(last) + bytes([padding])
+
+
+class StreamDecoder:
+    # последние два байта (последний байт данных и байт padding) придерживаются,
+    # пока не станет ясно, что поток закончился
+    def __init__(self, key: str):
+        self.xor = XORCipher.stream(key)
+        self.buffer = b''
+        self.codes: Optional[Dict[str, str]] = None
+        self._decoder: Optional[HuffmanDecoder] = None
+        self.state = 0
+
+    def __getstate__(self) -> dict:
+        # таблицы декодера в другой процесс не передаются, там они берутся из кэша по кодам
+        state = self.__dict__.copy()
+        state['_decoder'] = None
+        return state
+
+    @property
+    def started(self) -> bool:
+        return self.codes is not None
+
+    @property
+    def decoder(self) -> HuffmanDecoder:
+        if self._decoder is None:
+            self._decoder = HuffmanDecoder.for_codes(self.codes)
+        return self._decoder
+
+    def feed(self, data: bytes) -> str:
+        self.buffer += data
+        if self.codes is None:
+            if len(self.buffer) < STREAM_HEADER.size:
+                return ''
+            magic, header_size = STREAM_HEADER.unpack_from(self.buffer)
+            if magic != STREAM_MAGIC:
+                raise ValueError('Это не поток, сжатый этим сервисом')
+            if header_size > MAX_STREAM_HEADER:
+                raise ValueError('Заголовок потока слишком длинный')
+            end = STREAM_HEADER.size + header_size
+            if len(self.buffer) < end:
+                return ''
+            codes = HuffmanCoding.parse_header_bytes(self.buffer[STREAM_HEADER.size:end])
+            # у пустого документа кодов нет, после заголовка идет только байт padding;
+            # у остальных коды проверяются сразу, вместе с разбором заголовка
+            if codes:
+                self._decoder = HuffmanDecoder.for_codes(codes)
+            self.codes = codes
+            self.buffer = self.buffer[end:]
+        if len(self.buffer) <= 2:
+            return ''
+        if not self.codes:
+            raise ValueError('Данные не соответствуют кодам Хаффмана')
+        ready, self.buffer = self.buffer[:-2], self.buffer[-2:]
+        decoded, self.state = self.decoder.feed(self.xor.process(ready), self.state)
+        return decoded
+
+    def finish(self) -> str:
+        if self.codes is None or not self.buffer:
+            raise ValueError('Поток обрывается')
+        padding = self.buffer[-1]
+        last = self.buffer[:-1]
+        self.buffer = b''
+        if not last:
+            if padding or self.state:
+                raise ValueError('Поток обрывается')
+            return ''
+        if not self.codes:
+            raise ValueError('Данные не соответствуют кодам Хаффмана')
+        if padding > 7:
+            raise ValueError('padding должен быть от 0 до 7')
+        return self.decoder.finish(self.xor.process(last)[0], 8 - padding, self.state)
+
+
+def stream_step(coder, data):
+    # кусок потока для пула исполнителя: кодировщик или декодер уходит туда вместе с состоянием
+    # и возвращается обратно (из другого процесса - копией с новым состоянием)
+    return coder, coder.feed(data)
+
+
+def stream_finish(coder):
+    return coder, coder.finish()
+
+
+class SpooledUpload:
+    # загрузка во временный файл: в памяти до spool_size байт, дальше на диске;
+    # count=True - попутно считать частоты символов (первый проход потокового сжатия)
+    def __init__(self, spool_size: int, count: bool = False):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.frequency: Optional[Counter] = Counter() if count else None
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.size = 0
+
+    def write(self, chunk: bytes) -> None:
+        self.file.write(chunk)
+        self.size += len(chunk)
+        if self.frequency is not None:
+            self.frequency.update(self.utf8.decode(chunk))
+
+    def finish(self) -> None:
+        if self.frequency is not None:
+            self.frequency.update(self.utf8.decode(b'', final=True))
+        self.file.seek(0)
+
+    def read(self, size: int) -> bytes:
+        return self.file.read(size)
+
+    def close(self) -> None:
+        self.file.close()
\ No newline at end of file
@@ -0,0 +1,157 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import BrokenExecutor, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional, Tuple
+
+from app.core.config import settings
+
+# process - отдельные процессы: чистый python хаффмана держит GIL, и только так
+# сжатие не мешает остальным запросам; thread - потоки, дешевле, но помогают лишь там,
+# где код отпускает GIL (xor больших буферов, base64)
+EXECUTOR_BACKENDS = ("process", "thread")
+
+
+class ExecutorBusy(Exception):
+    # все воркеры заняты и очередь заполнена
+    pass
+
+
+class ExecutorTimeout(Exception):
+    # запрос не успел выполниться за отведенное время
+    pass
+
+
+class CodecExecutor:
+    # выполняет тяжелую работу кодека вне цикла событий; одновременно принимается
+    # не больше workers + queue_size задач, остальным сразу отказ, чтобы очередь
+    # не росла и время ответа оставалось предсказуемым
+    def __init__(self, backend: str = "process", workers: int = 0, queue_size: int = 16,
+                 timeout: float = 30.0):
+        if backend not in EXECUTOR_BACKENDS:
+            raise ValueError(f"Неизвестный тип исполнителя: {backend}")
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+        self.limit = self.workers + queue_size
+        self.timeout = timeout
+        self.pending = 0
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> Executor:
+        # пул создается при первом запросе, а сломанный (воркер упал) - заново
+        if self._executor is None:
+            if self.backend == "process":
+                # spawn, а не fork: в процессе веб-сервера уже работают потоки
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="codec")
+        return self._executor
+
+    def _acquire(self) -> None:
+        with self._lock:
+            if self.pending >= self.limit:
+                raise ExecutorBusy(f"Занято {self.pending} из {self.limit} мест")
+            self.pending += 1
+
+    def _release(self, future: Optional[Future] = None) -> None:
+        with self._lock:
+            self.pending -= 1
+
+    def _discard(self, pool: Executor) -> None:
+        # сломанный пул (упал воркер) выбрасываем, следующий запрос создаст новый;
+        # если его уже заменил другой запрос, новый пул не трогаем
+        with self._lock:
+            if self._executor is pool:
+                self._executor = None
+        pool.shutdown(wait=False)
+
+    def reserve(self) -> "ExecutorSlot":
+        # одно место на весь потоковый запрос: его куски потом идут в пул с reserved=True
+        # без повторной проверки, и поток не обрывается из-за занятой очереди посередине
+        self._acquire()
+        return ExecutorSlot(self)
+
+    def _submit(self, fn: Callable, args: tuple, kwargs: dict, reserved: bool) -> Tuple[Executor, Future]:
+        # место освобождается, когда задача действительно закончилась, а не когда
+        # клиент перестал ждать: уже запущенную задачу процесс доделывает до конца
+        if not reserved:
+            self._acquire()
+        try:
+            with self._lock:
+                pool = self._pool()
+            try:
+                future = pool.submit(fn, *args, **kwargs)
+            except BrokenExecutor:
+                self._discard(pool)
+                with self._lock:
+                    pool = self._pool()
+                future = pool.submit(fn, *args, **kwargs)
+        except BaseException:
+            if not reserved:
+                self._release()
+            raise
+        if not reserved:
+            future.add_done_callback(self._release)
+        return pool, future
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None, reserved: bool = False,
+                  **kwargs) -> Any:
+        # fn и аргументы должны сериализоваться через pickle (для process)
+        pool, future = self._submit(fn, args, kwargs, reserved)
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            # ждущая в очереди задача отменяется, запущенная - уже нет
+            future.cancel()
+            raise ExecutorTimeout(f"Запрос не выполнен за {timeout} с")
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BrokenExecutor:
+            self._discard(pool)
+            raise
+
+    def stats(self) -> dict:
+        # для /health: pending, упирающийся в limit, значит запросам уже отказывают с 503
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "workers": self.workers,
+                "limit": self.limit,
+                "pending": self.pending
+            }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+
+class ExecutorSlot:
+    # место, занятое через CodecExecutor.reserve; release можно вызывать несколько раз
+    def __init__(self, executor: CodecExecutor):
+        self.executor = executor
+        self.held = True
+
+    def release(self) -> None:
+        with self.executor._lock:
+            if not self.held:
+                return
+            self.held = False
+            self.executor.pending -= 1
+
+
+codec_executor = CodecExecutor(
+    settings.CODEC_EXECUTOR,
+    settings.CODEC_WORKERS,
+    settings.CODEC_QUEUE_SIZE,
+    settings.CODEC_TIMEOUT
+)
\ No newline at end of file
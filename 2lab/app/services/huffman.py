@@ -1,31 +1,73 @@
 import heapq
-from collections import defaultdict
-from typing import Dict, Tuple
+import base64
+import binascii
+import hashlib
+import json
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, Tuple
+
+# версия формата компактного заголовка с длинами кодов
+HEADER_VERSION = 1
+# больше символов в одной таблице кодов не принимаем: таблицы декодера растут с алфавитом
+MAX_SYMBOLS = 1 << 16
+# код Хаффмана длиной d бывает только у текста из не меньше чем F(d+2) символов (числа Фибоначчи),
+# так что 64 бит хватает любому тексту
+MAX_CODE_LENGTH = 64
 
 
 class HuffmanCoding:
+    # сколько символов (или бит строки) обрабатывать за раз в упакованном режиме
+    CHUNK_SIZE = 1 << 16
+
     @staticmethod
     def build_frequency_dict(text: str) -> Dict[str, int]:
-        frequency = defaultdict(int)
-        for char in text:
-            frequency[char] += 1
-        return frequency
+        return dict(Counter(text))
 
     @staticmethod
-    def build_huffman_tree(frequency: Dict[str, int]) -> Tuple:
-        heap = [[weight, [char, ""]] for char, weight in frequency.items()]
+    def code_lengths(frequency: Dict[str, int]) -> Dict[str, int]:
+        # длины кодов по дереву: каждое слияние - новый узел со ссылками из двух детей,
+        # строки кодов при этом не трогаем, так что построение O(n log n)
+        symbols = list(frequency)
+        heap = [(weight, idx) for idx, weight in enumerate(frequency.values())]
         heapq.heapify(heap)
-
+        parents = [0] * len(symbols)
         while len(heap) > 1:
-            lo = heapq.heappop(heap)
-            hi = heapq.heappop(heap)
-            for pair in lo[1:]:
-                pair[1] = '0' + pair[1]
-            for pair in hi[1:]:
-                pair[1] = '1' + pair[1]
-            heapq.heappush(heap, [lo[0] + hi[0]] + lo[1:] + hi[1:])
+            lo_weight, lo = heapq.heappop(heap)
+            hi_weight, hi = heapq.heappop(heap)
+            node = len(parents)
+            parents.append(0)
+            parents[lo] = parents[hi] = node
+            heapq.heappush(heap, (lo_weight + hi_weight, node))
+
+        # родитель всегда создан позже ребенка, поэтому глубины считаются с конца
+        depths = [0] * len(parents)
+        for node in range(len(parents) - 2, -1, -1):
+            depths[node] = depths[parents[node]] + 1
+        # у единственного символа дерево из одного листа, но код не может быть пустым
+        return {char: max(depths[idx], 1) for idx, char in enumerate(symbols)}
 
-        return heap[0]
+    @staticmethod
+    def canonical_codes(lengths: Dict[str, int]) -> Dict[str, str]:
+        # канонические коды: символы по (длине, символу), каждый следующий код на 1 больше
+        # предыдущего и дополнен нулями до своей длины; для восстановления хватает длин
+        codes = {}
+        code = 0
+        previous_length = 0
+        for char, length in sorted(lengths.items(), key=lambda item: (item[1], item[0])):
+            code <<= length - previous_length
+            codes[char] = format(code, f'0{length}b')
+            code += 1
+            previous_length = length
+        if code > 1 << previous_length:
+            raise ValueError('Длины кодов не образуют префиксный код')
+        return codes
+
+    @staticmethod
+    def build_huffman_tree(frequency: Dict[str, int]) -> Tuple:
+        # прежний формат результата: [суммарный вес, [символ, код], ...]
+        codes = HuffmanCoding.canonical_codes(HuffmanCoding.code_lengths(frequency))
+        return [sum(frequency.values())] + [[char, code] for char, code in codes.items()]
 
     @staticmethod
     def build_codes(tree: Tuple) -> Dict[str, str]:
@@ -35,6 +77,68 @@ class HuffmanCoding:
             codes[char] = code
         return codes
 
+    @staticmethod
+    def serialize_header(codes: Dict[str, str]) -> str:
+        # компактный заголовок вместо словаря кодов: версия, число символов,
+        # длины кодов по байту на символ и сами символы одной строкой utf-8, всё в base64
+        return base64.b64encode(HuffmanCoding.header_bytes(codes)).decode('ascii')
+
+    @staticmethod
+    def header_bytes(codes: Dict[str, str]) -> bytes:
+        lengths = {char: len(code) for char, code in codes.items()}
+        if HuffmanCoding.canonical_codes(lengths) != codes:
+            raise ValueError('В заголовок можно записать только канонические коды')
+        if any(length > 255 for length in lengths.values()):
+            raise ValueError('Код длиннее 255 бит не помещается в заголовок')
+        header = bytearray([HEADER_VERSION])
+        count = len(lengths)
+        while True:
+            # число символов - varint, по 7 бит на байт
+            header.append(count & 0x7f | (0x80 if count > 0x7f else 0))
+            count >>= 7
+            if not count:
+                break
+        header += bytes(lengths.values())
+        header += ''.join(lengths).encode('utf-8', 'surrogatepass')
+        return bytes(header)
+
+    @staticmethod
+    def parse_header(header: str) -> Dict[str, str]:
+        try:
+            data = base64.b64decode(header, validate=True)
+        except binascii.Error as e:
+            raise ValueError(f'Заголовок не в base64: {e}')
+        return HuffmanCoding.parse_header_bytes(data)
+
+    @staticmethod
+    def parse_header_bytes(data: bytes) -> Dict[str, str]:
+        if not data or data[0] != HEADER_VERSION:
+            raise ValueError('Неизвестная версия заголовка')
+        count = 0
+        shift = 0
+        offset = 1
+        while True:
+            if offset >= len(data):
+                raise ValueError('Заголовок обрывается')
+            byte = data[offset]
+            offset += 1
+            count |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        if count > MAX_SYMBOLS:
+            raise ValueError(f'В заголовке больше {MAX_SYMBOLS} символов')
+        lengths = data[offset:offset + count]
+        try:
+            symbols = data[offset + count:].decode('utf-8', 'surrogatepass')
+        except UnicodeDecodeError as e:
+            raise ValueError(f'Символы заголовка не в utf-8: {e}')
+        if len(lengths) != count or len(symbols) != count or len(set(symbols)) != count or 0 in lengths:
+            raise ValueError('Заголовок поврежден')
+        if lengths and max(lengths) > MAX_CODE_LENGTH:
+            raise ValueError(f'В заголовке код длиннее {MAX_CODE_LENGTH} бит')
+        return HuffmanCoding.canonical_codes(dict(zip(symbols, lengths)))
+
     @staticmethod
     def encode_text(text: str, codes: Dict[str, str]) -> Tuple[str, int]:
         encoded_text = ''.join([codes[char] for char in text])
@@ -46,15 +150,228 @@ class HuffmanCoding:
     def decode_text(encoded_text: str, codes: Dict[str, str], padding: int) -> str:
         if padding > 0:
             encoded_text = encoded_text[:-padding]
+        if not encoded_text:
+            # пустой текст сжимается без кодов, декодер для него не нужен
+            return ''
+
+        # строку бит упаковываем в байты и распаковываем тем же табличным декодером
+        packed = bytearray()
+        chunk_size = HuffmanCoding.CHUNK_SIZE
+        for start in range(0, len(encoded_text), chunk_size):
+            bits = encoded_text[start:start + chunk_size]
+            if bits.strip('01'):
+                raise ValueError('Закодированный текст должен состоять из 0 и 1')
+            if len(bits) % 8:
+                bits += '0' * (8 - len(bits) % 8)
+            packed += int(bits, 2).to_bytes(len(bits) // 8, 'big')
+        return HuffmanDecoder.for_codes(codes).decode(bytes(packed), (8 - len(encoded_text) % 8) % 8)
+
+    @staticmethod
+    def encode_bytes(text: str, codes: Dict[str, str]) -> Tuple[bytes, int]:
+        # биты сразу упаковываются в байты, строка из '0'/'1' строится только для куска текста;
+        # padding - сколько нулевых бит дописано в последний байт
+        packed, tail = HuffmanCoding.encode_chunk(text, codes)
+        last, padding = HuffmanCoding.finish_chunks(tail)
+        return packed + last, padding
+
+    @staticmethod
+    def encode_chunk(text: str, codes: Dict[str, str], tail: str = '') -> Tuple[bytes, str]:
+        # целые байты для куска текста и биты, не набравшие байт, - их передать со следующим
+        packed = bytearray()
+        chunk_size = HuffmanCoding.CHUNK_SIZE
+        for start in range(0, len(text), chunk_size):
+            bits = tail + ''.join(map(codes.__getitem__, text[start:start + chunk_size]))
+            whole = len(bits) - len(bits) % 8
+            if whole:
+                packed += int(bits[:whole], 2).to_bytes(whole // 8, 'big')
+            tail = bits[whole:]
+        return bytes(packed), tail
+
+    @staticmethod
+    def finish_chunks(tail: str) -> Tuple[bytes, int]:
+        # последний неполный байт, дополненный нулями, и число дописанных бит
+        padding = (8 - len(tail)) % 8
+        if not tail:
+            return b'', padding
+        return bytes([int(tail + '0' * padding, 2)]), padding
+
+    @staticmethod
+    def decode_bytes(data: bytes, codes: Dict[str, str], padding: int) -> str:
+        if not data:
+            return ''
+        return HuffmanDecoder.for_codes(codes).decode(data, padding)
+
+
+class HuffmanDecoder:
+    # табличный декодер: состояние - позиция в дереве кодов (незаконченный префикс),
+    # для каждой пары (состояние, байт) заранее известно, какие символы байт дописывает
+    # и где в дереве он заканчивается, так что на байт приходится один поиск в таблице;
+    # у больших алфавитов таблица байтов слишком велика, тогда шаг - полубайт или бит
+    TABLE_ENTRIES = 1 << 16
+    # кэш ограничен суммарным числом записей в таблицах (запись - около 100 байт), а не числом декодеров
+    CACHE_ENTRIES = 1 << 19
+    _cache: "OrderedDict[str, HuffmanDecoder]" = OrderedDict()
+    _cache_entries = 0
+    _cache_lock = threading.Lock()
+
+    def __init__(self, codes: Dict[str, str]):
+        if not codes:
+            raise ValueError('Нет кодов Хаффмана')
+        if len(codes) > MAX_SYMBOLS:
+            raise ValueError(f'В кодах Хаффмана больше {MAX_SYMBOLS} символов')
+        if not all(isinstance(char, str) and isinstance(code, str) for char, code in codes.items()):
+            raise ValueError('Символы и коды Хаффмана должны быть строками')
+        # дерево кодов: для каждого состояния и бита - символ (строка) или следующее
+        # состояние (число); корень - состояние 0; коды добавляются по порядку, чтобы номера
+        # состояний не зависели от порядка словаря и совпадали в любом процессе
+        tree = [[None, None]]
+        for char, code in sorted(codes.items(), key=lambda item: item[1]):
+            if not code or code.strip('01') or len(code) > MAX_CODE_LENGTH:
+                raise ValueError(
+                    f'Коды Хаффмана должны быть из 0 и 1 длиной от 1 до {MAX_CODE_LENGTH} и без общих префиксов'
+                )
+            state = 0
+            for bit in code[:-1]:
+                branch = tree[state]
+                target = branch[bit == '1']
+                if target is None:
+                    if len(tree) >= MAX_SYMBOLS:
+                        raise ValueError('Слишком много незаконченных префиксов в кодах Хаффмана')
+                    target = branch[bit == '1'] = len(tree)
+                    tree.append([None, None])
+                elif isinstance(target, str):
+                    raise ValueError('Коды Хаффмана должны быть без общих префиксов')
+                state = target
+            branch = tree[state]
+            if branch[code[-1] == '1'] is not None:
+                raise ValueError('Коды Хаффмана должны быть без общих префиксов')
+            branch[code[-1] == '1'] = char
+        # последнее состояние - тупик для кодов, которых нет в таблице
+        self.dead = len(tree)
+
+        # переходы по одному биту
+        self.bit_outputs: List[str] = []
+        self.bit_targets: List[int] = []
+        for branch in tree:
+            for target in branch:
+                if isinstance(target, str):
+                    self.bit_outputs.append(target)
+                    self.bit_targets.append(0)
+                else:
+                    self.bit_outputs.append('')
+                    self.bit_targets.append(self.dead if target is None else target)
+        self.bit_outputs += ['', '']
+        self.bit_targets += [self.dead, self.dead]
+
+        # самый широкий шаг, при котором таблица не больше TABLE_ENTRIES записей;
+        # в таблице состояние хранится уже умноженным на число значений шага
+        states = self.dead + 1
+        self.width = 8 if states << 8 <= self.TABLE_ENTRIES else 4 if states << 4 <= self.TABLE_ENTRIES else 1
+        if self.width == 1:
+            self.outputs = self.bit_outputs
+            self.targets = [target * 2 for target in self.bit_targets]
+            return
+
+        # переходы по полубайту из переходов по биту, по байту - из двух полубайтов
+        nibbles = []
+        for state in range(states):
+            for nibble in range(16):
+                current, emitted = state, []
+                for shift in (3, 2, 1, 0):
+                    step = current * 2 + (nibble >> shift & 1)
+                    emitted.append(self.bit_outputs[step])
+                    current = self.bit_targets[step]
+                nibbles.append((''.join(emitted), current))
+        if self.width == 4:
+            self.outputs = [output for output, _ in nibbles]
+            self.targets = [target * 16 for _, target in nibbles]
+            return
+        self.outputs = []
+        self.targets = []
+        for state in range(states):
+            for high in range(16):
+                high_output, middle = nibbles[state * 16 + high]
+                for low in range(16):
+                    low_output, target = nibbles[middle * 16 + low]
+                    self.outputs.append(high_output + low_output)
+                    self.targets.append(target * 256)
+
+    @property
+    def size(self) -> int:
+        # сколько записей занимают таблицы декодера
+        if self.outputs is self.bit_outputs:
+            return len(self.outputs)
+        return len(self.outputs) + len(self.bit_outputs)
+
+    @staticmethod
+    def table_key(codes: Dict[str, str]) -> str:
+        return hashlib.sha256(
+            json.dumps(sorted(codes.items()), ensure_ascii=False).encode('utf-8', 'surrogatepass')
+        ).hexdigest()
+
+    @classmethod
+    def for_codes(cls, codes: Dict[str, str]) -> "HuffmanDecoder":
+        # таблицы строятся один раз на набор кодов
+        key = cls.table_key(codes)
+        with cls._cache_lock:
+            decoder = cls._cache.get(key)
+            if decoder is not None:
+                cls._cache.move_to_end(key)
+                return decoder
+        decoder = cls(codes)
+        with cls._cache_lock:
+            if key not in cls._cache:
+                cls._cache[key] = decoder
+                HuffmanDecoder._cache_entries += decoder.size
+            while HuffmanDecoder._cache_entries > cls.CACHE_ENTRIES:
+                _, evicted = cls._cache.popitem(last=False)
+                HuffmanDecoder._cache_entries -= evicted.size
+        return decoder
 
-        reverse_codes = {v: k for k, v in codes.items()}
-        current_code = ""
-        decoded_text = []
+    def feed(self, data: bytes, state: int = 0) -> Tuple[str, int]:
+        # целые байты; state - состояние после предыдущего куска (как возвращено отсюда)
+        outputs = self.outputs
+        targets = self.targets
+        decoded = []
+        append = decoded.append
+        if self.width == 8:
+            for byte in data:
+                position = state + byte
+                append(outputs[position])
+                state = targets[position]
+        elif self.width == 4:
+            for byte in data:
+                position = state + (byte >> 4)
+                append(outputs[position])
+                position = targets[position] + (byte & 15)
+                append(outputs[position])
+                state = targets[position]
+        else:
+            for byte in data:
+                for shift in (7, 6, 5, 4, 3, 2, 1, 0):
+                    position = state + (byte >> shift & 1)
+                    append(outputs[position])
+                    state = targets[position]
+        return ''.join(decoded), state
 
-        for bit in encoded_text:
-            current_code += bit
-            if current_code in reverse_codes:
-                decoded_text.append(reverse_codes[current_code])
-                current_code = ""
+    def finish(self, last_byte: int, bits: int, state: int = 0) -> str:
+        # старшие bits бит последнего байта, дальше только дописанные нули
+        current = state >> self.width
+        decoded = []
+        for shift in range(7, 7 - bits, -1):
+            step = current * 2 + (last_byte >> shift & 1)
+            decoded.append(self.bit_outputs[step])
+            current = self.bit_targets[step]
+        if current == self.dead:
+            raise ValueError('Данные не соответствуют кодам Хаффмана')
+        if current != 0:
+            raise ValueError('Данные обрываются посреди кода Хаффмана')
+        return ''.join(decoded)
 
-        return ''.join(decoded_text)
\ No newline at end of file
+    def decode(self, data: bytes, padding: int) -> str:
+        if not data:
+            return ''
+        if not 0 <= padding < 8:
+            raise ValueError('padding должен быть от 0 до 7')
+        decoded, state = self.feed(data[:-1])
+        return decoded + self.finish(data[-1], 8 - padding, state)
\ No newline at end of file
@@ -1,8 +1,51 @@
 import base64
 
+
+class XORStream:
+    # xor потока байт по кускам любой длины: помнит, на каком байте ключа остановился;
+    # кусок обрабатывается блоками, каждый как одно большое число, без цикла по байтам;
+    # блок в 64 КБ помещается в кэш процессора, на больших блоках xor медленнее
+    BLOCK_SIZE = 1 << 16
+
+    def __init__(self, key: str, offset: int = 0):
+        self.key = key.encode('utf-8')
+        if not self.key:
+            raise ValueError('Ключ не может быть пустым')
+        # ключ, повторенный на длину куска с запасом на сдвиг фазы; растет по мере надобности
+        self.key_stream = b''
+        self.offset = offset
+
+    def __getstate__(self) -> dict:
+        # в другой процесс запас ключа не передаем, там он построится заново
+        return {'key': self.key, 'key_stream': b'', 'offset': self.offset}
+
+    def process(self, data: bytes) -> bytes:
+        if len(data) <= self.BLOCK_SIZE:
+            return self._process_block(data)
+        view = memoryview(data)
+        return b''.join(
+            self._process_block(view[start:start + self.BLOCK_SIZE])
+            for start in range(0, len(data), self.BLOCK_SIZE)
+        )
+
+    def _process_block(self, block: bytes) -> bytes:
+        size = len(block)
+        if not size:
+            return b''
+        phase = self.offset % len(self.key)
+        if len(self.key_stream) < phase + size:
+            self.key_stream = self.key * (-(-size // len(self.key)) + 1)
+        key_block = self.key_stream[phase:phase + size]
+        self.offset += size
+        return (int.from_bytes(block, 'big') ^ int.from_bytes(key_block, 'big')).to_bytes(size, 'big')
+
+
 class XORCipher:
     @staticmethod
     def encrypt(text: str, key: str) -> str:
+        # строки из ascii символов и ascii ключ: тот же результат через xor байт
+        if text.isascii() and key.isascii():
+            return base64.b64encode(XORCipher.xor_bytes(text.encode('ascii'), key)).decode()
         encrypted = []
         key_len = len(key)
         for i, char in enumerate(text):
@@ -13,11 +56,24 @@ class XORCipher:
 
     @staticmethod
     def decrypt(encrypted_text: str, key: str) -> str:
-        decoded = base64.b64decode(encrypted_text).decode()
+        raw = base64.b64decode(encrypted_text)
+        if raw.isascii() and key.isascii():
+            return XORCipher.xor_bytes(raw, key).decode('ascii')
+        decoded = raw.decode()
         decrypted = []
         key_len = len(key)
         for i, char in enumerate(decoded):
             key_char = key[i % key_len]
             decrypted_char = chr(ord(char) ^ ord(key_char))
             decrypted.append(decrypted_char)
-        return ''.join(decrypted)
\ No newline at end of file
+        return ''.join(decrypted)
+
+    @staticmethod
+    def xor_bytes(data: bytes, key: str, offset: int = 0) -> bytes:
+        # xor над байтами: шифрование и расшифровка - одна и та же операция;
+        # offset - позиция data в общем потоке, от нее зависит фаза ключа
+        return XORStream(key, offset).process(data)
+
+    @staticmethod
+    def stream(key: str, offset: int = 0) -> XORStream:
+        return XORStream(key, offset)
\ No newline at end of file
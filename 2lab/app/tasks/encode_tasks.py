@@ -1,32 +1,34 @@
-from app.services.huffman import HuffmanCoding
-from app.services.xor import XORCipher
-from app.core.celery_config import celery_app
+from typing import Dict, Optional
 
+from app.services.codec import TextCodec
+from app.core.celery_config import celery_app
 
-@celery_app.task(bind=True)
-def encode_task(self, text: str, key: str):
-    try:
-        self.update_state(state='PROGRESS', meta={'status': 'Huffman encoding...'}) # Обновление статуса задачи
 
-        # сжатие хаффмана
-        frequency = HuffmanCoding.build_frequency_dict(text)
-        tree = HuffmanCoding.build_huffman_tree(frequency)
-        codes = HuffmanCoding.build_codes(tree)
-        encoded_text, padding = HuffmanCoding.encode_text(text, codes)
+def report_progress(task, stages):
+    # статус PROGRESS с названием этапа и его номером, чтобы клиент мог показать прогресс
+    def progress(status: str) -> None:
+        task.update_state(
+            state='PROGRESS',
+            meta={'status': status, 'stage': stages.index(status) + 1, 'stages': len(stages)}
+        )
+    return progress
 
-        self.update_state(state='PROGRESS', meta={'status': 'XOR encryption...'})
 
-        # xor шифрование
-        encrypted_data = XORCipher.encrypt(encoded_text, key)
+@celery_app.task(bind=True)
+def encode_task(self, text: str, key: str, mode: str = "packed", codes_format: str = "header"):
+    try:
+        # сжатие хаффмана и xor шифрование, статус обновляется перед каждым этапом
+        result = TextCodec.encode(
+            text,
+            key,
+            mode,
+            progress=report_progress(self, TextCodec.ENCODE_STAGES),
+            codes_format=codes_format
+        )
 
         return {
             'status': 'SUCCESS',
-            'result': {
-                "encoded_data": encrypted_data,
-                "key": key,
-                "huffman_codes": codes,
-                "padding": padding
-            }
+            'result': result
         }
     except Exception as e:
         return {
@@ -36,20 +38,18 @@ def encode_task(self, text: str, key: str):
 
 
 @celery_app.task(bind=True)
-def decode_task(self, encoded_data: str, key: str, huffman_codes: dict, padding: int):
+def decode_task(self, encoded_data: str, key: str, huffman_codes: Optional[Dict[str, str]], padding: int,
+                mode: str = "packed", huffman_header: Optional[str] = None):
     try:
-        self.update_state(state='PROGRESS', meta={'status': 'XOR decryption...'})
-
-        # xor расшифровка
-        decrypted_data = XORCipher.decrypt(encoded_data, key)
-
-        self.update_state(state='PROGRESS', meta={'status': 'Huffman decoding...'})
-
-        # распаковка хаффмана
-        decoded_text = HuffmanCoding.decode_text(
-            decrypted_data,
+        # xor расшифровка и распаковка хаффмана
+        decoded_text = TextCodec.decode(
+            encoded_data,
+            key,
             huffman_codes,
-            padding
+            padding,
+            mode,
+            progress=report_progress(self, TextCodec.DECODE_STAGES),
+            huffman_header=huffman_header
         )
 
         return {